@@ -22,6 +22,28 @@ def portValid(port):
     except ValueError:
         return False
 
+def positiveIntegerValid(value):
+    try:
+        return int(value) > 0
+    except ValueError:
+        return False
+
+def chunkSizeValid(chunk_size):
+    try:
+        return MIN_CHUNK_SIZE <= int(chunk_size) <= MAX_CHUNK_SIZE
+    except ValueError:
+        return False
+
+def parseTrackers(trackers):
+    # "ip:port:signal_port,..." -> [(ip, port, signal_port), ...], or None if invalid
+    parsed_trackers = []
+    for tracker in trackers.split(TRACKER_LIST_DELIMITER):
+        parts = tracker.split(IP_PORT_DELIMITER)
+        if len(parts) != 3 or not parts[0] or not portValid(parts[1]) or not portValid(parts[2]):
+            return None
+        parsed_trackers.append((parts[0], int(parts[1]), int(parts[2])))
+    return parsed_trackers
+
 def validSettings(settings):
     if SETTINGS_ROLE_KEY not in settings:
         return False
@@ -41,6 +63,10 @@ def parse_args(system_arguments):
             if arg in SUPPORTED_FLAGS:
                 if arg == HOLE_PUNCHING_FLAG:
                     settings[SETTINGS_HOLE_PUNCHING_KEY] = True
+                elif arg == EVENT_LOOP_FLAG:
+                    settings[SETTINGS_EVENT_LOOP_KEY] = True
+                elif arg == PREALLOCATE_FLAG:
+                    settings[SETTINGS_PREALLOCATE_KEY] = True
                 else:
                     flag = arg
             else:
@@ -74,12 +100,60 @@ def parse_args(system_arguments):
             if flag == TRACKER_SIGNAL_PORT_FLAG:
                 if portValid(arg):
                     settings[SETTINGS_TRACKER_SIGNAL_PORT_KEY] = int(arg)
+            if flag == DOWNLOAD_WINDOW_FLAG:
+                if positiveIntegerValid(arg):
+                    settings[SETTINGS_DOWNLOAD_WINDOW_KEY] = int(arg)
+                else:
+                    sys.exit(DOWNLOAD_WINDOW_INVALID_MESSAGE)
+            if flag == CHUNK_SIZE_FLAG:
+                if chunkSizeValid(arg):
+                    settings[SETTINGS_CHUNK_SIZE_KEY] = int(arg)
+                else:
+                    sys.exit(CHUNK_SIZE_INVALID_MESSAGE)
+            if flag == HASH_WORKERS_FLAG:
+                if positiveIntegerValid(arg):
+                    settings[SETTINGS_HASH_WORKERS_KEY] = int(arg)
+                else:
+                    sys.exit(HASH_WORKERS_INVALID_MESSAGE)
+            if flag == UPLOAD_WORKERS_FLAG:
+                if positiveIntegerValid(arg):
+                    settings[SETTINGS_UPLOAD_WORKERS_KEY] = int(arg)
+                else:
+                    sys.exit(UPLOAD_WORKERS_INVALID_MESSAGE)
+            if flag == UPLOAD_RATE_FLAG:
+                if positiveIntegerValid(arg):
+                    settings[SETTINGS_UPLOAD_RATE_KEY] = int(arg)
+                else:
+                    sys.exit(UPLOAD_RATE_INVALID_MESSAGE)
+            if flag == STATS_PORT_FLAG:
+                if portValid(arg):
+                    settings[SETTINGS_STATS_PORT_KEY] = int(arg)
+                else:
+                    sys.exit(PORT_INVALID_MESSAGE)
+            if flag == STATE_DIR_FLAG:
+                if os.path.isdir(arg):
+                    settings[SETTINGS_STATE_DIR_KEY] = arg
+                else:
+                    sys.exit(DIRECTORY_DOES_NOT_EXIST_MESSAGE)
+            if flag == TRACKERS_FLAG:
+                trackers = parseTrackers(arg)
+                if trackers:
+                    settings[SETTINGS_TRACKERS_KEY] = trackers
+                else:
+                    sys.exit(TRACKERS_INVALID_MESSAGE)
             flag = ""
 
     # Arguments are left hanging
     if flag != "":
         sys.exit(flag + " is missing")
 
+    # A peer given a list of Trackers uses the first one wherever a single Tracker is needed
+    if SETTINGS_TRACKERS_KEY in settings and settings.get(SETTINGS_ROLE_KEY) == PEER_ROLE_NAME:
+        tracker_address, tracker_port, tracker_signal_port = settings[SETTINGS_TRACKERS_KEY][0]
+        settings.setdefault(SETTINGS_TRACKER_ADDRESS_KEY, tracker_address)
+        settings.setdefault(SETTINGS_TRACKER_PORT_KEY, tracker_port)
+        settings.setdefault(SETTINGS_TRACKER_SIGNAL_PORT_KEY, tracker_signal_port)
+
     if not validSettings(settings):
         sys.exit(SETTINGS_INVALID_MESSAGE)
     return settings
@@ -0,0 +1,101 @@
+import base64
+
+from constants import *
+
+def encode(chunk_numbers):
+    """
+    Encodes a collection of chunk numbers as a short string
+
+    "b<base64>" is a bitmap with the most significant bit of the first byte
+    standing for chunk 0. "r<n>,<n>,..." lists the lengths of alternating runs
+    of missing and owned chunks, starting with missing, which is much shorter
+    for the mostly full (or mostly empty) bitmaps most peers have. Whichever
+    of the two is shorter is used.
+    """
+    owned = sorted(set(int(i) for i in chunk_numbers))
+    if not owned:
+        return RLE_BITFIELD_PREFIX
+    bitmap = bytearray((owned[-1] >> 3) + 1)
+    for chunk_number in owned:
+        bitmap[chunk_number >> 3] |= 0x80 >> (chunk_number & 7)
+    encoded_bitmap = BITMAP_BITFIELD_PREFIX + base64.b64encode(str(bitmap))
+    runs = []
+    next_chunk_number = 0
+    for chunk_number in owned:
+        if runs and chunk_number == next_chunk_number:
+            runs[-1] += 1
+        else:
+            runs.append(chunk_number - next_chunk_number)
+            runs.append(1)
+        next_chunk_number = chunk_number + 1
+    encoded_runs = RLE_BITFIELD_PREFIX + ",".join(str(i) for i in runs)
+    if len(encoded_runs) <= len(encoded_bitmap):
+        return encoded_runs
+    return encoded_bitmap
+
+def decode(encoded, num_of_chunks):
+    """
+    Returns the sorted list of chunk numbers in a string made by encode
+
+    Chunk numbers from num_of_chunks on are left out, so a few bytes of
+    runs can never expand into more than the file's chunks. Raises
+    ValueError if the string is not a bitfield.
+    """
+    encoded = str(encoded)
+    if encoded.startswith(RLE_BITFIELD_PREFIX):
+        chunk_numbers = []
+        chunk_number = 0
+        is_owned = False
+        for run in encoded[len(RLE_BITFIELD_PREFIX):].split(","):
+            if not run:
+                continue
+            run = int(run)
+            if run < 0:
+                raise ValueError("Invalid bitfield")
+            if is_owned:
+                chunk_numbers.extend(range(chunk_number, min(chunk_number + run, num_of_chunks)))
+            chunk_number += run
+            if chunk_number >= num_of_chunks:
+                break
+            is_owned = not is_owned
+        return chunk_numbers
+    if encoded.startswith(BITMAP_BITFIELD_PREFIX):
+        try:
+            bitmap = bytearray(base64.b64decode(encoded[len(BITMAP_BITFIELD_PREFIX):]))
+        except TypeError:
+            raise ValueError("Invalid bitfield")
+        return [i for i in range(min(len(bitmap) * 8, num_of_chunks)) if bitmap[i >> 3] & (0x80 >> (i & 7))]
+    raise ValueError("Invalid bitfield")
+
+def validate(encoded):
+    # Raises ValueError if decode would, without listing any chunk numbers
+    if not isinstance(encoded, basestring):
+        raise ValueError("Invalid bitfield")
+    encoded = str(encoded)
+    if encoded.startswith(RLE_BITFIELD_PREFIX):
+        for run in encoded[len(RLE_BITFIELD_PREFIX):].split(","):
+            if run and int(run) < 0:
+                raise ValueError("Invalid bitfield")
+    else:
+        decode(encoded, 0)
+
+def get_chunk_numbers(peer_file_chunks, num_of_chunks):
+    # Chunk numbers below num_of_chunks of a {"filename": ..., "chunks": [...]}
+    # or {"filename": ..., "bitfield": "..."} entry of an announce
+    if MSG_BITFIELD_KEY in peer_file_chunks:
+        return decode(peer_file_chunks[MSG_BITFIELD_KEY], num_of_chunks)
+    return [i for i in peer_file_chunks[MSG_CHUNKS_KEY] if 0 <= int(i) < num_of_chunks]
+
+def validate_chunk_numbers(peer_file_chunks):
+    # Raises where get_chunk_numbers would
+    if MSG_BITFIELD_KEY in peer_file_chunks:
+        validate(peer_file_chunks[MSG_BITFIELD_KEY])
+    else:
+        for i in peer_file_chunks[MSG_CHUNKS_KEY]:
+            int(i)
+
+def encode_file_chunks(file_chunks_list):
+    # [{"filename": ..., "chunks": [...]}, ...] -> [{"filename": ..., "bitfield": "..."}, ...]
+    return [{MSG_FILENAME_KEY: file_chunks[MSG_FILENAME_KEY],
+             MSG_BITFIELD_KEY: encode(file_chunks[MSG_CHUNKS_KEY])}
+            for file_chunks in file_chunks_list]
@@ -0,0 +1,55 @@
+import time
+
+from constants import *
+
+class CongestionController(object):
+    """
+    AIMD window of chunk requests we keep outstanding with one owner
+
+    The window grows by one per delivered chunk until it reaches the slow
+    start threshold, then by one per window's worth of chunks. It is halved
+    on a request that timed out without any answer, or when a chunk takes more than
+    CONGESTION_DELAY_FACTOR times the lowest RTT seen from this owner, at
+    most once per round trip.
+    """
+    def __init__(self, initial_window, min_window, max_window):
+        self.window = float(initial_window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.slow_start_threshold = float(max_window)
+        self.min_rtt = None
+        self.loss_rate = 0.0
+        self.last_decrease = 0
+
+    def get_allowed_requests(self):
+        return max(self.min_window, int(self.window))
+
+    def on_chunk_received(self, rtt=None):
+        # rtt is None when no datagram was known to answer the last attempt (Karn's algorithm)
+        self.loss_rate *= 1 - LOSS_RATE_WEIGHT
+        if rtt is not None:
+            if self.min_rtt is None or rtt < self.min_rtt:
+                self.min_rtt = rtt
+            if rtt > self.min_rtt * CONGESTION_DELAY_FACTOR:
+                # Queues are building up somewhere between us and the owner
+                self.decrease(rtt)
+                return
+        if self.window < self.slow_start_threshold:
+            self.window += 1
+        else:
+            self.window += 1 / self.window
+        self.window = min(self.window, self.max_window)
+
+    def on_request_lost(self, rto):
+        self.loss_rate = self.loss_rate * (1 - LOSS_RATE_WEIGHT) + LOSS_RATE_WEIGHT
+        self.decrease(rto)
+
+    def decrease(self, round_trip):
+        # Losses within a round trip of the last decrease come from the same
+        # congestion event
+        now = time.time()
+        if now - self.last_decrease < round_trip:
+            return
+        self.last_decrease = now
+        self.slow_start_threshold = max(self.window / 2, self.min_window)
+        self.window = self.slow_start_threshold
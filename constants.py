@@ -9,6 +9,13 @@ REGISTER_PEER_SUCCESS_MESSAGE = "Successfully registered as Peer"
 REGISTER_PEER_FAILED_MESSAGE = "Unable to register as Peer. Exiting..."
 UPDATE_PEER_INFO_SUCCESS_MESSAGE = "Updated info successfully"
 UPDATE_PEER_INFO_FAIL_MESSAGE = "Update info unsuccessful"
+DOWNLOAD_WINDOW_INVALID_MESSAGE = "Download window invalid"
+CHUNK_SIZE_INVALID_MESSAGE = "Chunk size must be between 64 KiB and 4 MiB"
+HASH_WORKERS_INVALID_MESSAGE = "Number of hash workers invalid"
+UPLOAD_WORKERS_INVALID_MESSAGE = "Number of upload workers invalid"
+UPLOAD_RATE_INVALID_MESSAGE = "Upload rate invalid"
+TRACKERS_INVALID_MESSAGE = "Trackers must be a list of ip:port:signal_port separated by commas"
+TRACKER_NOT_IN_RING_MESSAGE = "This Tracker must appear exactly once in --trackers (use --tracker-address to tell them apart)"
 
 # Arguments flags
 ROLE_FLAG = "--role"
@@ -19,7 +26,24 @@ PEER_DIRECTORY_FLAG = "--peer-directory"
 HOLE_PUNCHING_FLAG = "--hole-punching"
 SIGNAL_PORT_FLAG = "--signal-port"
 TRACKER_SIGNAL_PORT_FLAG = "--tracker-signal-port"
-SUPPORTED_FLAGS = [ROLE_FLAG, PORT_FLAG, TRACKER_ADDRESS_FLAG, TRACKER_PORT_FLAG, PEER_DIRECTORY_FLAG, HOLE_PUNCHING_FLAG, SIGNAL_PORT_FLAG, TRACKER_SIGNAL_PORT_FLAG]
+DOWNLOAD_WINDOW_FLAG = "--download-window"
+CHUNK_SIZE_FLAG = "--chunk-size"
+HASH_WORKERS_FLAG = "--hash-workers"
+EVENT_LOOP_FLAG = "--event-loop"
+PREALLOCATE_FLAG = "--preallocate"
+UPLOAD_WORKERS_FLAG = "--upload-workers"
+# Upload cap in bytes per second
+UPLOAD_RATE_FLAG = "--upload-rate"
+# Tracker shards, as ip:port:signal_port,ip:port:signal_port,...
+TRACKERS_FLAG = "--trackers"
+# Directory the Tracker keeps its snapshot and write-ahead log in
+STATE_DIR_FLAG = "--state-dir"
+# Port on localhost serving metrics, see metrics.py
+STATS_PORT_FLAG = "--stats-port"
+SUPPORTED_FLAGS = [ROLE_FLAG, PORT_FLAG, TRACKER_ADDRESS_FLAG, TRACKER_PORT_FLAG, PEER_DIRECTORY_FLAG, HOLE_PUNCHING_FLAG, SIGNAL_PORT_FLAG, TRACKER_SIGNAL_PORT_FLAG,
+                   DOWNLOAD_WINDOW_FLAG, CHUNK_SIZE_FLAG, HASH_WORKERS_FLAG, EVENT_LOOP_FLAG, PREALLOCATE_FLAG,
+                   UPLOAD_WORKERS_FLAG, UPLOAD_RATE_FLAG, TRACKERS_FLAG, STATE_DIR_FLAG,
+                   STATS_PORT_FLAG]
 TRACKER_ROLE_NAME = "tracker"
 PEER_ROLE_NAME = "peer"
 
@@ -32,6 +56,16 @@ SETTINGS_PEER_DIRECTORY_KEY = "peer-directory"
 SETTINGS_HOLE_PUNCHING_KEY = "hole-punching"
 SETTINGS_SIGNAL_PORT_KEY = "signal-port"
 SETTINGS_TRACKER_SIGNAL_PORT_KEY = "tracker-signal-port"
+SETTINGS_DOWNLOAD_WINDOW_KEY = "download-window"
+SETTINGS_CHUNK_SIZE_KEY = "chunk-size"
+SETTINGS_HASH_WORKERS_KEY = "hash-workers"
+SETTINGS_EVENT_LOOP_KEY = "event-loop"
+SETTINGS_PREALLOCATE_KEY = "preallocate"
+SETTINGS_UPLOAD_WORKERS_KEY = "upload-workers"
+SETTINGS_UPLOAD_RATE_KEY = "upload-rate"
+SETTINGS_TRACKERS_KEY = "trackers"
+SETTINGS_STATE_DIR_KEY = "state-dir"
+SETTINGS_STATS_PORT_KEY = "stats-port"
 TRACKER_SETTINGS = [SETTINGS_ROLE_KEY, SETTINGS_PORT_KEY, SETTINGS_SIGNAL_PORT_KEY]
 PEER_SETTINGS = [SETTINGS_ROLE_KEY, SETTINGS_PORT_KEY, SETTINGS_TRACKER_ADDRESS_KEY, SETTINGS_TRACKER_PORT_KEY, SETTINGS_PEER_DIRECTORY_KEY, SETTINGS_SIGNAL_PORT_KEY, SETTINGS_TRACKER_SIGNAL_PORT_KEY]
 
@@ -41,10 +75,13 @@ SOCKET_CREATED_MESSAGE = "Socket created"
 # Message formats
 MESSAGE_TYPE_KEY = "message_type"
 INFORM_AND_UPDATE_MESSAGE_TYPE = "INFORM_AND_UPDATE"
+INFORM_DELTA_MESSAGE_TYPE = "INFORM_DELTA"
+RESYNC_MESSAGE_TYPE = "RESYNC"
 QUERY_LIST_OF_FILES_MESSAGE_TYPE = "QUERY_LIST_OF_FILES"
 QUERY_FILE_MESSAGE_TYPE = "QUERY_FILE"
 REQUEST_FILE_CHUNK_NAT_MESSAGE_TYPE = "REQUEST_FILE_CHUNK_NAT"
 EXIT_MESSAGE_TYPE = "EXIT"
+HEARTBEAT_MESSAGE_TYPE = "HEARTBEAT"
 QUERY_FILE_ERROR_MESSAGE_TYPE = "QUERY_FILE_ERROR"
 REQUEST_FILE_CHUNK_SIGNAL_MESSAGE_TYPE = "REQUEST_FILE_CHUNK_SIGNAL"
 NOT_YET_IMPLEMENTED_MESSAGE_TYPE = "NOT_YET_IMPLEMENTED"
@@ -52,6 +89,10 @@ ACK_MESSAGE_TYPE = "ACK"
 QUERY_LIST_OF_FILES_REPLY_MESSAGE_TYPE = "QUERY_LIST_OF_FILES_REPLY"
 QUERY_FILE_REPLY_MESSAGE_TYPE = "QUERY_FILE_REPLY"
 REQUEST_FILE_CHUNK_MESSAGE_TYPE = "REQUEST_FILE_CHUNK"
+PEX_MESSAGE_TYPE = "PEX"
+# Only used to label metrics of messages with a type we do not handle
+UNKNOWN_MESSAGE_TYPE = "UNKNOWN"
+MALFORMED_REQUEST_ERROR = "Malformed request"
 
 MSG_FILENAME_KEY = "filename"
 MSG_CHECKSUM_KEY = "checksum"
@@ -63,20 +104,178 @@ MSG_PEER_ID_KEY = "peer_id"
 MSG_SOURCE_IP_KEY = "source_ip"
 MSG_SOURCE_PORT_KEY = "source_port"
 MSG_FILES_KEY = "files"
+MSG_SEQUENCE_NUMBER_KEY = "sequence_number"
+MSG_FILES_ADDED_KEY = "files_added"
+MSG_FILES_REMOVED_KEY = "files_removed"
+MSG_CHUNKS_ADDED_KEY = "chunks_added"
+MSG_CHUNKS_REMOVED_KEY = "chunks_removed"
+# Compact chunk availability, see bitfield.py
+MSG_BITFIELD_KEY = "bitfield"
+MSG_BITFIELDS_KEY = "bitfields"
+MSG_SEEDERS_KEY = "seeders"
+MSG_ENCODING_KEY = "encoding"
+BITFIELD_ENCODING = "bitfield"
+RLE_BITFIELD_PREFIX = "r"
+BITMAP_BITFIELD_PREFIX = "b"
+# Optional QUERY_FILE limits: owners per chunk, and the chunks [first, last) to list
+MSG_MAX_PEERS_KEY = "max_peers"
+MSG_FIRST_CHUNK_KEY = "first_chunk"
+MSG_LAST_CHUNK_KEY = "last_chunk"
 
 MSG_SIGNAL_PORT_KEY = "signal_port"
 MSG_OWNER_ADDRESS_KEY = "owner_address"
 MSG_RECEIVER_ADDRESS_KEY = "receiver_address"
 MSG_FILE_DOWNLOAD_PROCESS_ID_KEY = "file_download_process_id"
 MSG_CHUNK_NUMBER_KEY = "chunk_number"
+MSG_CHUNK_SIZE_KEY = "chunk_size"
+# Size of a shared file in bytes, left out by older peers
+MSG_FILE_SIZE_KEY = "file_size"
+MSG_MISSING_DATAGRAMS_KEY = "missing_datagrams"
+# Attempt of a chunk request, echoed by the owner in the datagrams it sends
+MSG_ATTEMPT_KEY = "attempt"
 # Tracker
+# Seconds to wait on the Tracker before treating the connection as broken
+TRACKER_CONNECTION_TIMEOUT = 10
+# Peers send a HEARTBEAT every HEARTBEAT_INTERVAL seconds, the Tracker forgets
+# peers it has not heard from for PEER_EXPIRY_TIMEOUT seconds, looking for
+# them every PEER_EXPIRY_CHECK_INTERVAL seconds
+HEARTBEAT_INTERVAL = 15
+PEER_EXPIRY_TIMEOUT = 45
+PEER_EXPIRY_CHECK_INTERVAL = 5
+# Files a departing peer is removed from per acquisition of the tracker lock
+PEER_REMOVAL_BATCH_SIZE = 256
+# Places of every Tracker shard on the consistent hash ring, see hash_ring.py
+HASH_RING_REPLICAS = 64
+TRACKER_LIST_DELIMITER = ","
+# Tracker state on disk, see tracker_journal.py: a snapshot every
+# TRACKER_SNAPSHOT_INTERVAL seconds (if anything changed) and the log of
+# changes since, tracker.<generation>.log
+TRACKER_SNAPSHOT_FILENAME = "tracker.snapshot"
+TRACKER_LOG_PREFIX = "tracker."
+TRACKER_LOG_EXTENSION = ".log"
+TRACKER_SNAPSHOT_INTERVAL = 60
+SNAPSHOT_GENERATION_KEY = "generation"
+SNAPSHOT_FILE_DETAILS_KEY = "file_details"
+SNAPSHOT_PEERS_KEY = "peers"
 
 SYMMETRIC_NAT_TYPE = "Symmetric NAT"
 CHUNK_EXTENSION = ".chunk"
+# Downloads with --preallocate are written into <filename>.part, with the
+# chunks written so far in <filename>.part.bitmap
+PART_FILE_EXTENSION = ".part"
+PART_BITMAP_EXTENSION = ".bitmap"
+# Chunks are combined into <filename>.combining, renamed once complete
+COMBINING_EXTENSION = ".combining"
+COMBINE_BUFFER_SIZE = 1024 * 1024
+COMBINE_PROGRESS_STEP = 10
 CHUNKS_NEEDED = "chunks_needed"
+CHUNKS_IN_FLIGHT = "chunks_in_flight"
+CHUNK_FAILED_OWNERS = "chunk_failed_owners"
+REQUEST_OWNER_KEY = "owner"
+REQUEST_SENT_AT_KEY = "sent_at"
+REQUEST_ATTEMPTS_KEY = "attempts"
+PIECE_PICKER = "piece_picker"
+PARTIAL_CHUNKS = "partial_chunks"
+PARTIAL_CHUNK_DATA = "data"
+PARTIAL_CHUNK_RECEIVED = "received"
+REQUEST_LAST_ACTIVITY_KEY = "last_activity"
+REQUEST_RTT_KEY = "rtt"
+REQUEST_LAST_DATAGRAM_KEY = "last_datagram"
 IP_PORT_DELIMITER = ":"
 ID_DELIMITER = ","
+# Chunk size assumed for files announced without one (the old fixed size)
+LEGACY_CHUNK_SIZE = 1014
+DEFAULT_CHUNK_SIZE = 256 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Chunks travel as datagrams of at most MAX_DATAGRAM_SIZE bytes (fits a
+# 1500 byte Ethernet MTU), each starting with a DATAGRAM_HEADER_SIZE header
+# packed as DATAGRAM_HEADER_FORMAT, see datagram.py
+MAX_DATAGRAM_SIZE = 1472
+DATAGRAM_HEADER_FORMAT = "!HBBIIIIHI"
+DATAGRAM_HEADER_SIZE = 26
+DATAGRAM_MAGIC = 0x5032
+CHUNK_DATA_DATAGRAM_TYPE = 1
+DATAGRAM_PAYLOAD_SIZE = MAX_DATAGRAM_SIZE - DATAGRAM_HEADER_SIZE
 # Peer
+# Number of REQUEST_FILE_CHUNK messages kept outstanding per download
+DEFAULT_DOWNLOAD_WINDOW_SIZE = 8
+# Retransmission timeouts for chunk requests, in seconds
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 10.0
+RETRANSMISSION_CHECK_INTERVAL = 0.05
+# Congestion window of chunk requests in flight per owner, see congestion_control.py
+INITIAL_CONGESTION_WINDOW = 2
+MIN_CONGESTION_WINDOW = 1
+MAX_CONGESTION_WINDOW = 64
+# A chunk round trip this many times the lowest one seen counts as congestion
+CONGESTION_DELAY_FACTOR = 3.0
+# Weight of the latest request in the owner's moving average loss rate
+LOSS_RATE_WEIGHT = 0.1
+# Chunks fill_download_window looks past when their owners are all congested
+MAX_CONGESTED_CHUNKS_SKIPPED = 32
+CONGESTION_WINDOW_KEY = "window"
+LOSS_RATE_KEY = "loss_rate"
+# Owner selection, see owner_stats.py
+# Chance of requesting from a random owner instead of a fast one
+OWNER_PROBE_PROBABILITY = 0.1
+# Weight of the latest chunk in an owner's moving average RTT and goodput
+OWNER_STATS_WEIGHT = 0.2
+# Owners behind NAT are asked through the Tracker, count them as this much slower
+NAT_OWNER_WEIGHT = 0.5
+OWNER_RTT_KEY = "rtt"
+OWNER_GOODPUT_KEY = "goodput"
+OWNER_FAILURES_KEY = "failures"
+OWNER_BEHIND_NAT_KEY = "behind_nat"
+# Timeouts tolerated from one owner for a chunk before trying another owner
+MAX_CHUNK_ATTEMPTS_PER_OWNER = 2
+# Lost datagrams of a chunk asked for in one request, the rest are asked
+# for once those have arrived
+MAX_MISSING_DATAGRAMS_PER_REQUEST = 64
+SOCKET_RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+# Checksums of shared files are cached in this file inside the peer directory
+HASH_CACHE_FILENAME = ".p2p_hash_cache.json"
+HASH_CACHE_SIZE_KEY = "size"
+HASH_CACHE_MTIME_KEY = "mtime"
+HASH_CACHE_INODE_KEY = "inode"
+HASH_READ_BUFFER_SIZE = 1024 * 1024
+# Number of shared files kept open for serving chunks, and how often
+# (in seconds) the peer directory is checked for changes that invalidate them
+FILE_CACHE_SIZE = 64
+FILE_CACHE_CHECK_INTERVAL = 1.0
+# Threads serving chunk requests, and how many requests one requester can
+# have waiting for them
+DEFAULT_UPLOAD_WORKERS = 4
+MAX_QUEUED_UPLOADS_PER_REQUESTER = 64
+# Largest file the Tracker keeps track of, in chunks (64 GB in default size
+# chunks), announced chunk numbers past a file's last chunk are dropped
+MAX_CHUNKS_PER_FILE = 256 * 1024
+# Owners per chunk we ask the Tracker for
+MAX_PEERS_PER_CHUNK = 20
+# Seconds between chunk availability refreshes of unfinished downloads
+AVAILABILITY_REFRESH_INTERVAL = 30
+# Peer exchange, see peer_exchange.py
+# Seconds between PEX messages to the same requester about the same file
+PEX_INTERVAL = 5
+# Owners remembered per file, and listed at most in one PEX message
+PEX_MAX_OWNERS_PER_FILE = 200
+PEX_MAX_OWNERS_PER_MESSAGE = 50
+# Metrics, see metrics.py
+STATS_ADDRESS = "127.0.0.1"
+# Served in the Prometheus text format, every other path as JSON
+PROMETHEUS_STATS_PATH = "/metrics"
+COUNTER_METRIC_TYPE = "counter"
+HISTOGRAM_METRIC_TYPE = "histogram"
+GAUGE_METRIC_TYPE = "gauge"
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+HISTOGRAM_COUNT_KEY = "count"
+HISTOGRAM_SUM_KEY = "sum"
+HISTOGRAM_MAX_KEY = "max"
+HISTOGRAM_P50_KEY = "p50"
+HISTOGRAM_P90_KEY = "p90"
+HISTOGRAM_P99_KEY = "p99"
 TUI_STARTING_MESSAGE = """
 /////////////////////////////////////////////////////////////////////
 
@@ -98,4 +297,7 @@ Usage: 4
 
 5. Exit P2P Client
 Usage: 5
+
+6. Show statistics
+Usage: 6
 """
@@ -0,0 +1,81 @@
+import struct
+import zlib
+
+from constants import *
+
+# magic, type, attempt of the request being answered (0 if the sender does
+# not say), transfer (file download process) id, chunk number, offset in
+# chunk, chunk length, payload length, crc32 of payload
+DATAGRAM_HEADER = struct.Struct(DATAGRAM_HEADER_FORMAT)
+
+def payload_checksum(data, offset, length):
+    # crc32 of data[offset:offset + length] without copying it
+    return zlib.crc32(buffer(data, offset, length)) & 0xffffffff
+
+def is_chunk_datagram(data, num_of_bytes):
+    # Chunk data starts with DATAGRAM_MAGIC, everything else on the
+    # listening socket is a JSON message
+    if num_of_bytes < DATAGRAM_HEADER_SIZE:
+        return False
+    return struct.unpack_from("!H", data, 0)[0] == DATAGRAM_MAGIC
+
+def parse_chunk_datagram(data, num_of_bytes):
+    """
+    Returns (file_id, chunk_number, offset, chunk_length, payload_length,
+    attempt) of a chunk datagram received into data, or None if it is truncated or the
+    payload does not match its checksum. The payload is
+    data[DATAGRAM_HEADER_SIZE:DATAGRAM_HEADER_SIZE + payload_length].
+    """
+    magic, datagram_type, attempt, file_id, chunk_number, offset, chunk_length, payload_length, checksum = \
+        DATAGRAM_HEADER.unpack_from(data, 0)
+    if datagram_type != CHUNK_DATA_DATAGRAM_TYPE:
+        return None
+    if DATAGRAM_HEADER_SIZE + payload_length != num_of_bytes or offset + payload_length > chunk_length:
+        return None
+    if payload_checksum(data, DATAGRAM_HEADER_SIZE, payload_length) != checksum:
+        return None
+    return file_id, chunk_number, offset, chunk_length, payload_length, attempt
+
+class ChunkDatagramSender(object):
+    """
+    Sends the datagrams of one chunk to one requester
+
+    The payload is never sliced out of the chunk: with sendmsg the header and
+    a memoryview of the chunk are handed to the kernel as they are, otherwise
+    both are assembled in a single datagram buffer allocated once per chunk.
+    """
+    def __init__(self, sock, file_id, chunk_number, chunk_data, attempt=0):
+        self.sock = sock
+        self.attempt = attempt & 0xff
+        self.file_id = file_id
+        self.chunk_number = chunk_number
+        self.chunk_data = chunk_data
+        self.chunk_view = memoryview(chunk_data)
+        self.chunk_length = len(chunk_data)
+        self.sendmsg = getattr(sock, "sendmsg", None)
+        if self.sendmsg is None:
+            self.datagram = bytearray(MAX_DATAGRAM_SIZE)
+            self.datagram_view = memoryview(self.datagram)
+        else:
+            self.header = bytearray(DATAGRAM_HEADER_SIZE)
+
+    def get_payload_length(self, datagram_number):
+        offset = datagram_number * DATAGRAM_PAYLOAD_SIZE
+        return max(0, min(DATAGRAM_PAYLOAD_SIZE, self.chunk_length - offset))
+
+    def send(self, datagram_number, addr):
+        offset = datagram_number * DATAGRAM_PAYLOAD_SIZE
+        payload_length = self.get_payload_length(datagram_number)
+        checksum = payload_checksum(self.chunk_data, offset, payload_length)
+        if self.sendmsg is None:
+            DATAGRAM_HEADER.pack_into(self.datagram, 0, DATAGRAM_MAGIC, CHUNK_DATA_DATAGRAM_TYPE, self.attempt,
+                                      self.file_id, self.chunk_number, offset, self.chunk_length,
+                                      payload_length, checksum)
+            end = DATAGRAM_HEADER_SIZE + payload_length
+            self.datagram_view[DATAGRAM_HEADER_SIZE:end] = self.chunk_view[offset:offset + payload_length]
+            self.sock.sendto(self.datagram_view[:end], addr)
+        else:
+            DATAGRAM_HEADER.pack_into(self.header, 0, DATAGRAM_MAGIC, CHUNK_DATA_DATAGRAM_TYPE, self.attempt,
+                                      self.file_id, self.chunk_number, offset, self.chunk_length,
+                                      payload_length, checksum)
+            self.sendmsg([self.header, self.chunk_view[offset:offset + payload_length]], [], 0, addr)
@@ -0,0 +1,181 @@
+import socket
+import select
+import errno
+import json
+import framing
+import logger
+
+from framing import FrameDecoder
+
+# Same values for select.epoll and select.poll
+READ_EVENTS = select.POLLIN | select.POLLPRI
+WRITE_EVENTS = select.POLLOUT
+ERROR_EVENTS = select.POLLERR | select.POLLHUP
+
+class Poller(object):
+    # select.epoll where available (Linux), select.poll everywhere else
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.timeout_scale = 1
+        else:
+            self.poller = select.poll()
+            self.timeout_scale = 1000
+
+    def register(self, fd, events):
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        # timeout in seconds
+        return self.poller.poll(timeout * self.timeout_scale)
+
+class Connection(object):
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.decoder = FrameDecoder()
+        self.out_buffer = bytearray()
+        # None until the first byte tells us if the peer frames its messages
+        self.is_legacy = None
+        self.legacy_data = ""
+        self.close_after_write = False
+        self.is_waiting_to_write = False
+
+class EventLoopServer(object):
+    """
+    Serves the Tracker's TCP protocol and drains its UDP signal socket from a
+    single thread
+
+    handle_message(data, addr) is called for every request and returns the
+    serialized reply. handle_datagram(data, addr) is called for every
+    datagram arriving on the UDP socket.
+    """
+    def __init__(self, tcp_socket, udp_socket, handle_message, handle_datagram):
+        self.tcp_socket = tcp_socket
+        self.udp_socket = udp_socket
+        self.handle_message = handle_message
+        self.handle_datagram = handle_datagram
+        self.connections = {}
+        self.poller = Poller()
+        self.is_running = False
+
+    def serve_forever(self):
+        self.tcp_socket.setblocking(0)
+        self.udp_socket.setblocking(0)
+        self.poller.register(self.tcp_socket.fileno(), READ_EVENTS)
+        self.poller.register(self.udp_socket.fileno(), READ_EVENTS)
+        self.is_running = True
+        while self.is_running:
+            for fd, events in self.poller.poll(1):
+                if fd == self.tcp_socket.fileno():
+                    self.accept_connections()
+                elif fd == self.udp_socket.fileno():
+                    self.read_datagrams()
+                elif fd in self.connections:
+                    self.handle_connection_events(self.connections[fd], events)
+
+    def stop(self):
+        self.is_running = False
+
+    def accept_connections(self):
+        while True:
+            try:
+                conn, addr = self.tcp_socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            conn.setblocking(0)
+            self.connections[conn.fileno()] = Connection(conn, addr)
+            self.poller.register(conn.fileno(), READ_EVENTS)
+
+    def read_datagrams(self):
+        while True:
+            try:
+                data, addr = self.udp_socket.recvfrom(65535)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.handle_datagram(data, addr)
+
+    def handle_connection_events(self, connection, events):
+        try:
+            if events & (READ_EVENTS | ERROR_EVENTS):
+                self.read_connection(connection)
+            if connection.sock is not None and events & WRITE_EVENTS:
+                self.write_connection(connection)
+        except Exception as msg:
+            # Whatever goes wrong with one connection, keep serving the others
+            logger.print_connection_error_message(connection.addr, msg)
+            self.close_connection(connection)
+
+    def read_connection(self, connection):
+        while connection.sock is not None:
+            try:
+                data = connection.sock.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                self.close_connection(connection)
+                return
+            if connection.is_legacy is None:
+                connection.is_legacy = data[0] == "{"
+            if connection.is_legacy:
+                self.read_legacy_message(connection, data)
+            else:
+                for request_id, payload in connection.decoder.feed(data):
+                    return_data = self.handle_message(payload, connection.addr)
+                    self.queue_write(connection, framing.FRAME_HEADER.pack(len(return_data), request_id) + return_data)
+
+    def read_legacy_message(self, connection, data):
+        # Unframed peers send a single JSON message and wait for us to close
+        # the connection after the reply
+        connection.legacy_data += data
+        try:
+            json.loads(connection.legacy_data)
+        except ValueError:
+            return
+        return_data = self.handle_message(connection.legacy_data, connection.addr)
+        connection.close_after_write = True
+        self.queue_write(connection, return_data)
+
+    def queue_write(self, connection, data):
+        connection.out_buffer += data
+        self.write_connection(connection)
+        if connection.sock is not None and connection.out_buffer and not connection.is_waiting_to_write:
+            # Could not send everything right away, wait until the socket drains
+            self.poller.modify(connection.sock.fileno(), READ_EVENTS | WRITE_EVENTS)
+            connection.is_waiting_to_write = True
+
+    def write_connection(self, connection):
+        while connection.out_buffer:
+            try:
+                sent = connection.sock.send(connection.out_buffer)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            del connection.out_buffer[:sent]
+        if connection.close_after_write:
+            self.close_connection(connection)
+        elif connection.is_waiting_to_write:
+            self.poller.modify(connection.sock.fileno(), READ_EVENTS)
+            connection.is_waiting_to_write = False
+
+    def close_connection(self, connection):
+        if connection.sock is None:
+            return
+        fd = connection.sock.fileno()
+        self.poller.unregister(fd)
+        self.connections.pop(fd, None)
+        connection.sock.close()
+        connection.sock = None
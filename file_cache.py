@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from constants import *
+
+class FileCache(object):
+    """
+    Least recently used set of open files we serve chunks from
+
+    Serving a chunk from a cached file is a seek and a read on a descriptor
+    we already have: no stat, open or close. Reading a file that was
+    truncated or rewritten in place just returns what is there now. Files
+    are read rather than memory mapped because touching a mapping past the
+    end of a truncated file kills the process with SIGBUS.
+
+    A descriptor is used by one reader at a time, taken out of the cache
+    for the read and put back after it, so upload workers never wait on
+    each other's disk reads; a file read by several workers at once gets a
+    descriptor for each. At most max_open_files idle descriptors are kept.
+
+    Everything is dropped when the directory's modification time changes
+    (checked at most every FILE_CACHE_CHECK_INTERVAL seconds) and when the
+    Peer rescans its directory, so a replaced or deleted file is never
+    served from a stale descriptor.
+    """
+    def __init__(self, directory, max_open_files=FILE_CACHE_SIZE):
+        self.directory = directory
+        self.max_open_files = max_open_files
+        # Idle descriptors, least recently used file first
+        # { path: [file descriptor, ...] }
+        self.descriptors = OrderedDict()
+        self.num_of_descriptors = 0
+        # Bumped whenever the cache is cleared, descriptors taken out before
+        # that are closed instead of put back
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.directory_mtime = None
+        self.last_directory_check = 0
+
+    def read(self, path, offset, length):
+        """
+        Returns length bytes of the file at path from offset on (fewer at the
+        end of the file), or None if the file does not exist
+        """
+        with self.lock:
+            self.check_directory()
+            fd = self.take_descriptor(path)
+            generation = self.generation
+        if fd is None:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except (IOError, OSError):
+                return None
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            data = os.read(fd, length)
+        except OSError:
+            # Not a regular file (or gone bad), do not keep it around
+            os.close(fd)
+            return None
+        with self.lock:
+            if generation == self.generation:
+                self.put_descriptor(path, fd)
+            else:
+                os.close(fd)
+        return data
+
+    def take_descriptor(self, path):
+        # An idle descriptor of path, or None. Must be called with self.lock held
+        fds = self.descriptors.pop(path, None)
+        if not fds:
+            return None
+        self.num_of_descriptors -= 1
+        fd = fds.pop()
+        if fds:
+            self.descriptors[path] = fds
+        return fd
+
+    def put_descriptor(self, path, fd):
+        # Must be called with self.lock held
+        # Most recently used last
+        fds = self.descriptors.pop(path, [])
+        fds.append(fd)
+        self.descriptors[path] = fds
+        self.num_of_descriptors += 1
+        while self.num_of_descriptors > self.max_open_files:
+            least_recent_path = next(iter(self.descriptors))
+            fds = self.descriptors[least_recent_path]
+            os.close(fds.pop(0))
+            self.num_of_descriptors -= 1
+            if not fds:
+                del self.descriptors[least_recent_path]
+
+    def check_directory(self):
+        now = time.time()
+        if now - self.last_directory_check < FILE_CACHE_CHECK_INTERVAL:
+            return
+        self.last_directory_check = now
+        try:
+            directory_mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            directory_mtime = None
+        if directory_mtime != self.directory_mtime:
+            self.directory_mtime = directory_mtime
+            self.clear_locked()
+
+    def invalidate(self):
+        with self.lock:
+            self.clear_locked()
+
+    def clear_locked(self):
+        self.generation += 1
+        while self.descriptors:
+            for fd in self.descriptors.popitem()[1]:
+                os.close(fd)
+        self.num_of_descriptors = 0
@@ -1,6 +1,9 @@
 import os
+import io
 import glob
 
+from constants import *
+
 
 def get_chunk_number_from_chunk_filename(filename):
 	splitNames = filename.split(".")
@@ -21,18 +24,60 @@ def remove_all_associated_chunks(directory, filename):
 		os.remove(filename)
 	return
 
-def combine_chunks(directory, filename, num_of_keys, chunk_size):
-	chunk_index = 0
-	new_file_directory = os.path.join(directory, filename)
-	while(chunk_index < num_of_keys):
-		chunk_file_name = filename + "." + str(chunk_index) + ".chunk"
-		chunk_file_directory = os.path.join(directory, chunk_file_name)
-
-		with open(new_file_directory, 'ab') as new_file:
-			with open(chunk_file_directory, 'rb') as chunk_file:
-				new_file.write(chunk_file.read(chunk_size))
+def copy_fd_range(src_fd, dst_fd, length, buffer_view):
+    # Copies length bytes from src_fd to dst_fd at their current offsets,
+    # inside the kernel where the platform allows it
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    while length > 0:
+        copied = 0
+        if copy_file_range is not None:
+            try:
+                copied = copy_file_range(src_fd, dst_fd, length)
+            except OSError:
+                # e.g. across file systems on older kernels
+                copy_file_range = None
+                continue
+        elif sendfile is not None:
+            try:
+                copied = sendfile(dst_fd, src_fd, None, length)
+            except OSError:
+                sendfile = None
+                continue
+        else:
+            # Read into the one reused buffer and write it out from there
+            copied = io.FileIO(src_fd, closefd=False).readinto(buffer_view[:min(length, len(buffer_view))])
+            written = 0
+            while written < copied:
+                written += os.write(dst_fd, buffer_view[written:copied])
+        if copied == 0:
+            break
+        length -= copied
 
-		chunk_index+=1
+def combine_chunks(directory, filename, num_of_keys, chunk_size, progress_func=None):
+    """
+    Concatenates the .chunk files of filename through a single descriptor
+    for the new file, then removes them
 
-		if(chunk_index == num_of_keys):
-			remove_all_associated_chunks(directory, filename)
+    The new file is only given its name once every chunk has been copied.
+    progress_func(chunks_done, num_of_keys) is called after every chunk.
+    """
+    new_file_directory = os.path.join(directory, filename)
+    combining_file_directory = new_file_directory + COMBINING_EXTENSION
+    buffer_view = memoryview(bytearray(COMBINE_BUFFER_SIZE))
+    new_file_fd = os.open(combining_file_directory, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for chunk_index in range(num_of_keys):
+            chunk_file_name = filename + "." + str(chunk_index) + ".chunk"
+            chunk_file_fd = os.open(os.path.join(directory, chunk_file_name), os.O_RDONLY)
+            try:
+                chunk_length = min(chunk_size, os.fstat(chunk_file_fd).st_size)
+                copy_fd_range(chunk_file_fd, new_file_fd, chunk_length, buffer_view)
+            finally:
+                os.close(chunk_file_fd)
+            if progress_func is not None:
+                progress_func(chunk_index + 1, num_of_keys)
+    finally:
+        os.close(new_file_fd)
+    os.rename(combining_file_directory, new_file_directory)
+    remove_all_associated_chunks(directory, filename)
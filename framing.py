@@ -0,0 +1,59 @@
+import struct
+import socket
+
+# Every message on a Tracker connection is preceded by its length and the id
+# of the request it belongs to, both unsigned 32 bit big endian integers
+FRAME_HEADER = struct.Struct("!II")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+def send_frame(sock, request_id, payload):
+    sock.sendall(FRAME_HEADER.pack(len(payload), request_id) + payload)
+
+def recv_exactly(sock, num_of_bytes):
+    # Returns exactly num_of_bytes bytes, or None if the connection was closed
+    # before the first one arrived
+    data = bytearray()
+    while len(data) < num_of_bytes:
+        new_bytes = sock.recv(num_of_bytes - len(data))
+        if not new_bytes:
+            if not data:
+                return None
+            raise socket.error("Connection closed in the middle of a frame")
+        data += new_bytes
+    return bytes(data)
+
+def recv_frame(sock):
+    # Returns (request_id, payload), or None once the peer closed the connection
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length, request_id = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise socket.error("Frame of " + str(length) + " bytes is too large")
+    payload = recv_exactly(sock, length) if length else b""
+    if payload is None:
+        raise socket.error("Connection closed in the middle of a frame")
+    return request_id, payload
+
+class FrameDecoder(object):
+    """
+    Incremental decoder for non-blocking sockets: feed it whatever recv
+    returned and get back the frames that are now complete
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        # Returns a list of (request_id, payload)
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            length, request_id = FRAME_HEADER.unpack_from(bytes(self.buffer[:FRAME_HEADER.size]))
+            if length > MAX_FRAME_SIZE:
+                raise socket.error("Frame of " + str(length) + " bytes is too large")
+            frame_end = FRAME_HEADER.size + length
+            if len(self.buffer) < frame_end:
+                break
+            frames.append((request_id, bytes(self.buffer[FRAME_HEADER.size:frame_end])))
+            del self.buffer[:frame_end]
+        return frames
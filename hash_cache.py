@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+import multiprocessing
+
+from constants import *
+
+def compute_file_checksum(full_path):
+    # md5 of a file, read HASH_READ_BUFFER_SIZE bytes at a time so memory use
+    # does not grow with the size of the file
+    md5 = hashlib.md5()
+    with open(full_path, 'rb') as f:
+        while True:
+            data = f.read(HASH_READ_BUFFER_SIZE)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+def hash_file_worker(full_path):
+    # Runs in a worker process, hence a module level function
+    try:
+        return full_path, compute_file_checksum(full_path)
+    except (IOError, OSError):
+        # The file went away while we were hashing it
+        return full_path, None
+
+class HashCache(object):
+    """
+    On-disk cache of file checksums
+
+    Entries are keyed by path and are only trusted while the file's size,
+    modification time and inode are unchanged, so unchanged files are never
+    hashed twice, not even across restarts.
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        # { path: {"size": 1, "mtime": 1.0, "inode": 1, "checksum": "checksum"} }
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                self.entries = json.load(cache_file)
+        except (IOError, ValueError):
+            # Missing or corrupt cache, everything gets hashed again
+            self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        # Write to a temporary file first so a crash never leaves half a cache behind
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self.entries, cache_file)
+        os.rename(temp_path, self.cache_path)
+        self.dirty = False
+
+    def lookup(self, full_path, stat):
+        # Returns the cached checksum, or None if the file changed since it was hashed
+        entry = self.entries.get(full_path)
+        if entry is None:
+            return None
+        if (entry[HASH_CACHE_SIZE_KEY] != stat.st_size or entry[HASH_CACHE_MTIME_KEY] != stat.st_mtime
+                or entry[HASH_CACHE_INODE_KEY] != stat.st_ino):
+            return None
+        return entry[MSG_CHECKSUM_KEY]
+
+    def store(self, full_path, stat, checksum):
+        self.entries[full_path] = {
+            HASH_CACHE_SIZE_KEY: stat.st_size,
+            HASH_CACHE_MTIME_KEY: stat.st_mtime,
+            HASH_CACHE_INODE_KEY: stat.st_ino,
+            MSG_CHECKSUM_KEY: checksum
+        }
+        self.dirty = True
+
+    def get_checksum(self, full_path, stat):
+        checksum = self.lookup(full_path, stat)
+        if checksum is None:
+            checksum = compute_file_checksum(full_path)
+            self.store(full_path, stat, checksum)
+        return checksum
+
+    def hash_files(self, full_paths, num_of_workers):
+        """
+        Brings the cache up to date for full_paths, hashing the files that are
+        new or changed on a pool of num_of_workers processes
+
+        Each worker reads one file at a time, so num_of_workers also bounds the
+        number of files being read concurrently. Results are stored as soon as
+        each file finishes, in whatever order that happens.
+        """
+        stats = {}
+        for full_path in full_paths:
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                # Deleted since the directory was listed
+                self.evict(full_path)
+                continue
+            if self.lookup(full_path, stat) is None:
+                stats[full_path] = stat
+        if not stats:
+            return
+        num_of_workers = min(num_of_workers, len(stats))
+        if num_of_workers <= 1:
+            results = (hash_file_worker(full_path) for full_path in stats)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(num_of_workers)
+            results = pool.imap_unordered(hash_file_worker, stats.keys())
+        try:
+            for full_path, checksum in results:
+                if checksum is not None:
+                    self.store(full_path, stats[full_path], checksum)
+                else:
+                    self.evict(full_path)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def evict(self, full_path):
+        if self.entries.pop(full_path, None) is not None:
+            self.dirty = True
+
+    def prune(self, existing_paths):
+        # Forget files that are no longer in the directory
+        for full_path in set(self.entries) - set(existing_paths):
+            self.evict(full_path)
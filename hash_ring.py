@@ -0,0 +1,26 @@
+import bisect
+import hashlib
+
+from constants import *
+
+def hash_key(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class HashRing(object):
+    """
+    Consistent hash ring of Tracker shards, each identified by "ip:port"
+
+    Every shard is placed on the ring HASH_RING_REPLICAS times and a file
+    belongs to the first shard at or after the hash of its name, so adding
+    or removing a shard only moves the files next to its own places.
+    """
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        self.nodes = list(nodes)
+        self.points = sorted((hash_key(node + "#" + str(i)), node) for node in self.nodes for i in range(replicas))
+        self.point_hashes = [point_hash for point_hash, _ in self.points]
+
+    def get_node(self, key):
+        index = bisect.bisect(self.point_hashes, hash_key(key)) % len(self.points)
+        return self.points[index][1]
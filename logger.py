@@ -1,3 +1,4 @@
+import json
 from constants import *
 def print_starting_message():
     print(P2P_STARTING_MESSAGE)
@@ -17,6 +18,9 @@ def print_socket_bind_message():
 def print_not_yet_implemented_message():
     print ("Not yet implemented")
 
+def print_malformed_message(error):
+    print ("Rejected a malformed message: " + repr(error))
+
 def print_tracker_stopping_message():
     print ("Stopping tracker")
 
@@ -73,3 +77,28 @@ def print_receive_signal_message():
 
 def print_file_exists():
     print("File already exists in your directory")
+
+def print_chunk_timeout_message(filename, chunk_number, owner):
+    print("Request for chunk " + str(chunk_number) + " of " + filename + " to " + owner + " timed out, retrying")
+
+def print_connection_error_message(addr, msg):
+    print("Connection with " + str(addr) + " failed: " + str(msg))
+
+def print_combine_progress_message(filename, percent_done):
+    print("Combining chunks of " + filename + ": " + str(percent_done) + "%")
+
+def print_combine_done_message(filename):
+    print("Finished downloading " + filename)
+
+def print_upload_error_message(msg):
+    print("Failed to send a file chunk: " + str(msg))
+
+def print_peer_expired_message(peer_id):
+    print("No heartbeat from " + peer_id + ", removing it")
+
+def print_stats(stats):
+    print(json.dumps(stats, indent=4, sort_keys=True))
+
+def print_tracker_state_restored_message(num_of_peers, num_of_files):
+    print("Restored " + str(num_of_files) + " files and " + str(num_of_peers) +
+          " peers, waiting for the peers to check in")
@@ -0,0 +1,233 @@
+import bisect
+import json
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from constants import *
+
+class Counter(object):
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def collect(self):
+        return self.value
+
+class Histogram(object):
+    """
+    Number of observations in each of the buckets (upper bounds, in
+    ascending order), with their count, sum and maximum
+    """
+    def __init__(self, lock, buckets):
+        self.lock = lock
+        self.buckets = buckets
+        # The last one counts the observations above every bucket
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def get_percentile(self, fraction):
+        # Upper bound of the bucket the percentile falls in, or the largest
+        # observation if that is above every bucket
+        rank = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def collect(self):
+        with self.lock:
+            return {HISTOGRAM_COUNT_KEY: self.count, HISTOGRAM_SUM_KEY: self.sum, HISTOGRAM_MAX_KEY: self.max,
+                    HISTOGRAM_P50_KEY: self.get_percentile(0.5), HISTOGRAM_P90_KEY: self.get_percentile(0.9),
+                    HISTOGRAM_P99_KEY: self.get_percentile(0.99)}
+
+class MetricFamily(object):
+    """
+    A metric and its children, one per combination of label values
+
+    Metrics without labels have a single child, which inc and observe
+    update directly.
+    """
+    def __init__(self, name, metric_type, help_text, label_names, create_child):
+        self.name = name
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.label_names = label_names
+        self.create_child = create_child
+        # { (label value, ...): Counter or Histogram }
+        self.children = {}
+        if not label_names:
+            # Reported as 0 before the first inc or observe
+            self.children[()] = create_child()
+        self.lock = threading.Lock()
+
+    def labels(self, *label_values):
+        with self.lock:
+            if label_values not in self.children:
+                self.children[label_values] = self.create_child()
+            return self.children[label_values]
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def get_children(self):
+        with self.lock:
+            return sorted(self.children.items())
+
+class Gauge(object):
+    """
+    A value read when the metrics are collected, from func
+
+    With label_names, func returns { label value: value } (or
+    { (label value, ...): value }) instead of a single value.
+    """
+    def __init__(self, name, help_text, func, label_names):
+        self.name = name
+        self.metric_type = GAUGE_METRIC_TYPE
+        self.help_text = help_text
+        self.func = func
+        self.label_names = label_names
+
+    def get_children(self):
+        if not self.label_names:
+            return [((), self.func())]
+        children = []
+        for label_values, value in self.func().items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            children.append((label_values, value))
+        return sorted(children)
+
+class MetricsRegistry(object):
+    """
+    Counters, histograms and gauges of a Peer or Tracker, collected as a
+    dict (for JSON and the TUI) or rendered in the Prometheus text format
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Metrics in the order they were registered
+        self.metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        metric = MetricFamily(name, COUNTER_METRIC_TYPE, help_text, label_names, lambda: Counter(self.lock))
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        metric = MetricFamily(name, HISTOGRAM_METRIC_TYPE, help_text, label_names,
+                              lambda: Histogram(self.lock, buckets))
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, func, label_names=()):
+        metric = Gauge(name, help_text, func, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        # { name: value } for metrics without labels,
+        # { name: { "label value,...": value } } for the others
+        stats = {}
+        for metric in self.metrics:
+            values = {}
+            for label_values, child in metric.get_children():
+                values[ID_DELIMITER.join(label_values)] = child if metric.metric_type == GAUGE_METRIC_TYPE \
+                    else child.collect()
+            stats[metric.name] = values.get("") if not metric.label_names else values
+        return stats
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.help_text)
+            lines.append("# TYPE " + metric.name + " " + metric.metric_type)
+            for label_values, child in metric.get_children():
+                labels = zip(metric.label_names, label_values)
+                if metric.metric_type == GAUGE_METRIC_TYPE:
+                    lines.append(format_sample(metric.name, labels, child))
+                elif metric.metric_type == COUNTER_METRIC_TYPE:
+                    lines.append(format_sample(metric.name, labels, child.collect()))
+                else:
+                    lines.extend(format_histogram(metric.name, labels, child))
+        return "\n".join(lines) + "\n"
+
+def format_sample(name, labels, value):
+    if not labels:
+        return name + " " + repr(value)
+    label_text = ",".join(label_name + "=" + json.dumps(str(label_value)) for label_name, label_value in labels)
+    return name + "{" + label_text + "} " + repr(value)
+
+def format_histogram(name, labels, histogram):
+    with histogram.lock:
+        bucket_counts = list(histogram.bucket_counts)
+        count = histogram.count
+        total = histogram.sum
+    lines = []
+    cumulative_count = 0
+    for bound, bucket_count in zip(histogram.buckets, bucket_counts):
+        cumulative_count += bucket_count
+        lines.append(format_sample(name + "_bucket", labels + [("le", repr(bound))], cumulative_count))
+    lines.append(format_sample(name + "_bucket", labels + [("le", "+Inf")], count))
+    lines.append(format_sample(name + "_sum", labels, total))
+    lines.append(format_sample(name + "_count", labels, count))
+    return lines
+
+class StatsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == PROMETHEUS_STATS_PATH:
+            body = registry.render_prometheus()
+            content_type = "text/plain; version=0.0.4"
+        else:
+            body = json.dumps(registry.collect(), sort_keys=True)
+            content_type = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be printed to stderr
+        return
+
+class StatsHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class StatsServer(object):
+    """
+    Serves a registry over HTTP on localhost: PROMETHEUS_STATS_PATH in the
+    Prometheus text format, any other path as JSON
+    """
+    def __init__(self, port, registry):
+        self.server = StatsHTTPServer((STATS_ADDRESS, port), StatsRequestHandler)
+        self.server.registry = registry
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,61 @@
+import random
+
+class OwnerSample(object):
+    """
+    Set of the peers owning a chunk that can hand out a random sample of
+    them without copying the whole set
+
+    Peers are kept in a list with their position in a dict, a peer is
+    removed by moving the last one into its place.
+    """
+    def __init__(self):
+        self.owners = []
+        self.positions = {}
+
+    def add(self, peer_id):
+        if peer_id not in self.positions:
+            self.positions[peer_id] = len(self.owners)
+            self.owners.append(peer_id)
+
+    def discard(self, peer_id):
+        position = self.positions.pop(peer_id, None)
+        if position is None:
+            return
+        last_owner = self.owners.pop()
+        if position < len(self.owners):
+            self.owners[position] = last_owner
+            self.positions[last_owner] = position
+
+    def __contains__(self, peer_id):
+        return peer_id in self.positions
+
+    def __len__(self):
+        return len(self.owners)
+
+    def __iter__(self):
+        return iter(self.owners)
+
+    def sample(self, num_of_owners, is_excluded):
+        """
+        Up to num_of_owners random owners for which is_excluded is false.
+        Takes O(num_of_owners) time no matter how many owners there are;
+        when most owners are excluded fewer than num_of_owners may be
+        returned.
+        """
+        if num_of_owners <= 0:
+            return []
+        if len(self.owners) <= 2 * num_of_owners:
+            candidates = [i for i in self.owners if not is_excluded(i)]
+            return random.sample(candidates, min(num_of_owners, len(candidates)))
+        sampled_owners = []
+        sampled_positions = set()
+        for _ in range(4 * num_of_owners):
+            position = random.randrange(len(self.owners))
+            if position in sampled_positions:
+                continue
+            sampled_positions.add(position)
+            if not is_excluded(self.owners[position]):
+                sampled_owners.append(self.owners[position])
+                if len(sampled_owners) == num_of_owners:
+                    break
+        return sampled_owners
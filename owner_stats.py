@@ -0,0 +1,82 @@
+from random import random, choice
+
+from constants import *
+
+class OwnerStats(object):
+    """
+    What we have observed of each owner we download from: round trip time,
+    goodput, failed requests and whether we have to reach it through the
+    Tracker's signal server
+
+    choose_owner favours owners with high goodput and few failures, while
+    every so often picking one at random so that owners we know little
+    about (or that have become faster) get a chance to prove themselves.
+    """
+    def __init__(self):
+        # { owner: {"rtt": 0.1, "goodput": 1000000.0, "failures": 0, "behind_nat": False} }
+        self.owners = {}
+
+    def get(self, owner):
+        if owner not in self.owners:
+            self.owners[owner] = {OWNER_RTT_KEY: None, OWNER_GOODPUT_KEY: None,
+                                  OWNER_FAILURES_KEY: 0, OWNER_BEHIND_NAT_KEY: False}
+        return self.owners[owner]
+
+    def record_chunk(self, owner, num_of_bytes, seconds, rtt=None):
+        # A chunk of num_of_bytes arrived seconds after it was requested
+        stats = self.get(owner)
+        goodput = num_of_bytes / max(seconds, 0.001)
+        if stats[OWNER_GOODPUT_KEY] is None:
+            stats[OWNER_GOODPUT_KEY] = goodput
+        else:
+            stats[OWNER_GOODPUT_KEY] += OWNER_STATS_WEIGHT * (goodput - stats[OWNER_GOODPUT_KEY])
+        if rtt is not None:
+            if stats[OWNER_RTT_KEY] is None:
+                stats[OWNER_RTT_KEY] = rtt
+            else:
+                stats[OWNER_RTT_KEY] += OWNER_STATS_WEIGHT * (rtt - stats[OWNER_RTT_KEY])
+        # Old failures are forgiven one delivered chunk at a time
+        stats[OWNER_FAILURES_KEY] = max(0, stats[OWNER_FAILURES_KEY] - 1)
+
+    def record_failure(self, owner):
+        self.get(owner)[OWNER_FAILURES_KEY] += 1
+
+    def set_peers_behind_nat(self, peers_behind_nat):
+        peers_behind_nat = set(peers_behind_nat)
+        for owner, stats in self.owners.items():
+            stats[OWNER_BEHIND_NAT_KEY] = owner in peers_behind_nat
+        for owner in peers_behind_nat:
+            self.get(owner)[OWNER_BEHIND_NAT_KEY] = True
+
+    def get_score(self, owner, default_goodput):
+        stats = self.get(owner)
+        goodput = stats[OWNER_GOODPUT_KEY]
+        if goodput is None:
+            # Optimistic about owners we have not tried yet
+            goodput = default_goodput
+        score = goodput / (1 + stats[OWNER_FAILURES_KEY])
+        if stats[OWNER_BEHIND_NAT_KEY]:
+            # Every request takes a detour through the Tracker
+            score *= NAT_OWNER_WEIGHT
+        return score
+
+    def choose_owner(self, candidates, owner_load):
+        """
+        Picks one of candidates, at random with probability
+        OWNER_PROBE_PROBABILITY and otherwise in proportion to its score
+        divided by the requests we already have outstanding with it
+        """
+        if len(candidates) == 1:
+            return candidates[0]
+        if random() < OWNER_PROBE_PROBABILITY:
+            return choice(candidates)
+        known_goodputs = [self.owners[o][OWNER_GOODPUT_KEY] for o in candidates
+                          if o in self.owners and self.owners[o][OWNER_GOODPUT_KEY] is not None]
+        default_goodput = max(known_goodputs) if known_goodputs else 1.0
+        weights = [self.get_score(o, default_goodput) / (1 + owner_load.get(o, 0)) for o in candidates]
+        point = random() * sum(weights)
+        for owner, weight in zip(candidates, weights):
+            point -= weight
+            if point <= 0:
+                return owner
+        return candidates[-1]
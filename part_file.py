@@ -0,0 +1,185 @@
+import os
+import struct
+import threading
+
+from constants import *
+
+# Sidecar header: file size (0 until the last chunk arrives), number of
+# chunks, chunk size. The bitmap of chunks written follows, most significant
+# bit of the first byte standing for chunk 0.
+PART_BITMAP_HEADER = struct.Struct("!QII")
+
+def get_part_path(directory, filename):
+    return os.path.join(directory, filename + PART_FILE_EXTENSION)
+
+def get_bitmap_path(directory, filename):
+    return os.path.join(directory, filename + PART_FILE_EXTENSION + PART_BITMAP_EXTENSION)
+
+def is_part_file(name):
+    return name.endswith(PART_FILE_EXTENSION) or name.endswith(PART_FILE_EXTENSION + PART_BITMAP_EXTENSION)
+
+def get_filename_from_bitmap_name(name):
+    return name[:-len(PART_FILE_EXTENSION + PART_BITMAP_EXTENSION)]
+
+def pwrite(fd, data, offset, lock):
+    # os.pwrite only exists on Python 3, seek and write under lock otherwise
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, data, offset)
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+def pread(fd, length, offset, lock):
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+class PartFile(object):
+    """
+    A download in progress, kept as a single preallocated <filename>.part file
+
+    Every chunk is written at its offset as soon as it arrives, and its bit
+    is set in the <filename>.part.bitmap sidecar afterwards, so a restarted
+    peer can carry on from the chunks on disk. Finishing the download is a
+    truncate and a rename.
+
+    Upload workers read chunks through the same descriptor. Closing waits
+    for the reads in progress, and chunks asked for once the download is
+    finished are read from the renamed file.
+    """
+    def __init__(self, directory, filename, num_of_chunks, chunk_size):
+        self.directory = directory
+        self.filename = filename
+        self.num_of_chunks = num_of_chunks
+        self.chunk_size = chunk_size
+        self.file_size = 0
+        self.bitmap = bytearray((num_of_chunks + 7) / 8)
+        self.lock = threading.Lock()
+        # Reads in progress, the descriptors are only closed once there are none
+        self.num_of_readers = 0
+        self.is_closed = False
+        self.is_completed = False
+        self.readers_changed = threading.Condition()
+        self.part_fd = os.open(get_part_path(directory, filename), os.O_RDWR | os.O_CREAT, 0o644)
+        self.bitmap_fd = os.open(get_bitmap_path(directory, filename), os.O_RDWR | os.O_CREAT, 0o644)
+        self.load_bitmap()
+        # Sparse, blocks are only allocated as chunks get written
+        if os.fstat(self.part_fd).st_size < num_of_chunks * chunk_size:
+            os.ftruncate(self.part_fd, num_of_chunks * chunk_size)
+
+    @staticmethod
+    def open_existing(directory, filename):
+        # Reopens a .part file left by an earlier download, or returns None
+        header = read_bitmap_header(directory, filename)
+        if header is None:
+            return None
+        file_size, num_of_chunks, chunk_size = header
+        return PartFile(directory, filename, num_of_chunks, chunk_size)
+
+    def load_bitmap(self):
+        data = os.read(self.bitmap_fd, PART_BITMAP_HEADER.size + len(self.bitmap))
+        if len(data) == PART_BITMAP_HEADER.size + len(self.bitmap):
+            file_size, num_of_chunks, chunk_size = PART_BITMAP_HEADER.unpack_from(data, 0)
+            if num_of_chunks == self.num_of_chunks and chunk_size == self.chunk_size:
+                self.file_size = file_size
+                self.bitmap = bytearray(data[PART_BITMAP_HEADER.size:])
+                return
+        # Missing or from a different version of the file, start over
+        self.bitmap = bytearray(len(self.bitmap))
+        os.ftruncate(self.part_fd, 0)
+        os.ftruncate(self.bitmap_fd, 0)
+        pwrite(self.bitmap_fd, self.pack_header() + str(self.bitmap), 0, self.lock)
+
+    def pack_header(self):
+        return PART_BITMAP_HEADER.pack(self.file_size, self.num_of_chunks, self.chunk_size)
+
+    def has_chunk(self, chunk_number):
+        return bool(self.bitmap[chunk_number >> 3] & (0x80 >> (chunk_number & 7)))
+
+    def get_owned_chunks(self):
+        return [i for i in range(self.num_of_chunks) if self.has_chunk(i)]
+
+    def is_complete(self):
+        return all(self.has_chunk(i) for i in range(self.num_of_chunks))
+
+    def write_chunk(self, chunk_number, data):
+        pwrite(self.part_fd, data, chunk_number * self.chunk_size, self.lock)
+        if chunk_number == self.num_of_chunks - 1:
+            # Only the last chunk tells us how long the file really is
+            self.file_size = chunk_number * self.chunk_size + len(data)
+            pwrite(self.bitmap_fd, self.pack_header(), 0, self.lock)
+        # The bit goes to disk after the data it stands for
+        index = chunk_number >> 3
+        self.bitmap[index] |= 0x80 >> (chunk_number & 7)
+        pwrite(self.bitmap_fd, str(self.bitmap[index:index + 1]), PART_BITMAP_HEADER.size + index, self.lock)
+
+    def read_chunk(self, chunk_number):
+        # Returns the chunk, or None if it has not been downloaded yet
+        if not self.has_chunk(chunk_number):
+            return None
+        length = self.chunk_size
+        if chunk_number == self.num_of_chunks - 1:
+            length = self.file_size - chunk_number * self.chunk_size
+        offset = chunk_number * self.chunk_size
+        with self.readers_changed:
+            if self.is_closed:
+                return self.read_completed_chunk(length, offset) if self.is_completed else None
+            self.num_of_readers += 1
+        try:
+            return pread(self.part_fd, length, offset, self.lock)
+        finally:
+            with self.readers_changed:
+                self.num_of_readers -= 1
+                self.readers_changed.notify_all()
+
+    def read_completed_chunk(self, length, offset):
+        # Reads a chunk from the downloaded file, for readers that come after complete()
+        try:
+            with open(os.path.join(self.directory, self.filename), "rb") as completed_file:
+                completed_file.seek(offset)
+                return completed_file.read(length)
+        except (IOError, OSError):
+            return None
+
+    def complete(self):
+        # Turns the .part file into the downloaded file, the descriptors stay
+        # valid through the rename for the reads still in progress
+        os.ftruncate(self.part_fd, self.file_size)
+        os.fsync(self.part_fd)
+        os.rename(get_part_path(self.directory, self.filename), os.path.join(self.directory, self.filename))
+        os.remove(get_bitmap_path(self.directory, self.filename))
+        self.is_completed = True
+        self.close()
+
+    def close(self):
+        # Waits for the reads in progress, later ones do not touch the descriptors
+        with self.readers_changed:
+            self.is_closed = True
+            while self.num_of_readers:
+                self.readers_changed.wait()
+        os.close(self.part_fd)
+        os.close(self.bitmap_fd)
+
+def read_bitmap_header(directory, filename):
+    # (file size, number of chunks, chunk size) from a sidecar, or None
+    try:
+        with open(get_bitmap_path(directory, filename), "rb") as bitmap_file:
+            data = bitmap_file.read(PART_BITMAP_HEADER.size)
+    except (IOError, OSError):
+        return None
+    if len(data) < PART_BITMAP_HEADER.size:
+        return None
+    return PART_BITMAP_HEADER.unpack(data)
+
+def read_owned_chunks(directory, filename):
+    # Chunks of a .part file according to its sidecar, without opening the .part file
+    header = read_bitmap_header(directory, filename)
+    if header is None:
+        return []
+    file_size, num_of_chunks, chunk_size = header
+    with open(get_bitmap_path(directory, filename), "rb") as bitmap_file:
+        bitmap_file.seek(PART_BITMAP_HEADER.size)
+        bitmap = bytearray(bitmap_file.read((num_of_chunks + 7) / 8))
+    return [i for i in range(min(num_of_chunks, len(bitmap) * 8)) if bitmap[i >> 3] & (0x80 >> (i & 7))]
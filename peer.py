@@ -1,18 +1,32 @@
 from __future__ import print_function
 import socket
 import threading
-# import multiprocessing
+import multiprocessing
 import sys
 import json
 import os, glob
-import hashlib
 import stun
 import file_utils
 import logger
+import bitfield
+import datagram
+import part_file
+import time
 
 from constants import *
 from runner import Runner
-from random import randint
+from rtt_estimator import RttEstimator
+from congestion_control import CongestionController
+from owner_stats import OwnerStats
+from peer_exchange import PeerExchange, is_valid_pex_message
+from hash_ring import HashRing
+from piece_picker import PiecePicker
+from hash_cache import HashCache
+from file_cache import FileCache
+from upload_scheduler import UploadScheduler, TokenBucket
+from tracker_connection import TrackerConnection
+from recurring_thread import RecurringThread
+from metrics import MetricsRegistry, StatsServer
 
 class Peer(Runner):
     def __init__(self, settings):
@@ -22,22 +36,108 @@ class Peer(Runner):
         self.tracker_port = settings[SETTINGS_TRACKER_PORT_KEY]
         self.port = settings[SETTINGS_PORT_KEY]
         self.directory = settings[SETTINGS_PEER_DIRECTORY_KEY]
+        self.hash_cache = HashCache(os.path.join(self.directory, HASH_CACHE_FILENAME))
+        # Open files we serve chunks from
+        self.file_cache = FileCache(self.directory)
+        # Chunk requests are served by a pool of workers, one requester at a time
+        self.upload_scheduler = UploadScheduler(settings.get(SETTINGS_UPLOAD_WORKERS_KEY, DEFAULT_UPLOAD_WORKERS),
+                                                self.send_a_file_chunk_to_a_peer)
+        self.upload_rate_limiter = None
+        if SETTINGS_UPLOAD_RATE_KEY in settings:
+            self.upload_rate_limiter = TokenBucket(settings[SETTINGS_UPLOAD_RATE_KEY])
+        self.hash_workers = settings.get(SETTINGS_HASH_WORKERS_KEY, multiprocessing.cpu_count())
         self.hole_punch = SETTINGS_HOLE_PUNCHING_KEY in settings
         self.tracker_signal_port = settings[SETTINGS_TRACKER_SIGNAL_PORT_KEY]
+        # Every Tracker shard as (ip, port, signal_port), just the one Tracker without --trackers
+        trackers = settings.get(SETTINGS_TRACKERS_KEY,
+                                [(self.tracker_address, self.tracker_port, self.tracker_signal_port)])
+        # Connection and signal server address of each shard, by "ip:port"
+        self.tracker_connections = {}
+        self.tracker_signal_addresses = {}
+        for tracker_address, tracker_port, tracker_signal_port in trackers:
+            tracker_id = tracker_address + IP_PORT_DELIMITER + str(tracker_port)
+            self.tracker_connections[tracker_id] = TrackerConnection(tracker_address, tracker_port)
+            self.tracker_signal_addresses[tracker_id] = (tracker_address, tracker_signal_port)
+        # Each file is announced to and looked up on the shard its name hashes to
+        self.tracker_ring = HashRing([t[0] + IP_PORT_DELIMITER + str(t[1]) for t in trackers])
         self.signal_port = settings[SETTINGS_SIGNAL_PORT_KEY]
         self.external_ip = None
         self.external_port = None
         self.external_signal_port = None
-        self.chunk_size = 1014 #byte
+        # Size of the chunks that files we share are split into, in bytes
+        self.chunk_size = settings.get(SETTINGS_CHUNK_SIZE_KEY, DEFAULT_CHUNK_SIZE)
+        self.download_window_size = settings.get(SETTINGS_DOWNLOAD_WINDOW_KEY, DEFAULT_DOWNLOAD_WINDOW_SIZE)
+        # Download into one preallocated .part file instead of a file per chunk
+        self.preallocate = SETTINGS_PREALLOCATE_KEY in settings
+        # PartFile of every .part file being downloaded or served, by filename
+        self.part_files = {}
+        self.part_files_lock = threading.Lock()
+        # Files whose chunks are being combined in the background
+        self.combining_files = set()
         self.socket_listening_thread = None
         self.signal_listening_thread = None
         # List of (formatted) files that the Peer is sharing
         self.files = []
         # List of (formatted) incomplete files that the Peer is sharing
         self.chunks = []
+        # What the Tracker last acknowledged, updates only send the difference
+        self.announce_sequence_number = 0
+        self.announced_files = {}
+        self.announced_chunks = {}
+        # Held while an announce and its commit_announcement are in progress
+        self.announce_lock = threading.Lock()
+        self.heartbeat_thread = None
         self.file_download_process_info = []
+        # Guards self.file_download_process_info between the TUI and listening threads
+        self.download_lock = threading.Lock()
+        # RttEstimator per owner "ip:port", used for retransmission timeouts
+        self.owner_rtt = {}
+        # CongestionController per owner "ip:port", limits our requests in flight to it
+        self.owner_congestion = {}
+        # RTT, goodput, failures and NAT status per owner, for choosing owners
+        self.owner_stats = OwnerStats()
+        # Owners learnt from the Tracker and from other peers, gossiped along with chunks
+        self.peer_exchange = PeerExchange()
+        self.availability_refresh_thread = None
         self.connect = None
         self.known_peers_behind_nat = []
+        self.metrics = MetricsRegistry()
+        self.create_metrics()
+        self.stats_server = None
+        if SETTINGS_STATS_PORT_KEY in settings:
+            self.stats_server = StatsServer(settings[SETTINGS_STATS_PORT_KEY], self.metrics)
+
+    def create_metrics(self):
+        self.chunks_requested_metric = self.metrics.counter("p2p_chunks_requested_total",
+                                                            "Chunk requests sent, retransmissions included")
+        self.chunk_retransmits_metric = self.metrics.counter("p2p_chunk_retransmits_total",
+                                                             "Chunk requests sent again after losses")
+        self.chunks_received_metric = self.metrics.counter("p2p_chunks_received_total", "Chunks downloaded")
+        self.bytes_received_metric = self.metrics.counter("p2p_bytes_received_total",
+                                                          "Chunk payload bytes received")
+        self.chunk_download_seconds_metric = self.metrics.histogram(
+            "p2p_chunk_download_seconds", "Time from the last request of a chunk to its last datagram")
+        self.chunks_served_metric = self.metrics.counter("p2p_chunks_served_total", "Chunks uploaded")
+        self.bytes_sent_metric = self.metrics.counter("p2p_bytes_sent_total", "Chunk payload bytes sent")
+        self.metrics.gauge("p2p_downloads_in_progress", "Downloads with chunks still needed",
+                           self.get_num_of_downloads_in_progress)
+        self.metrics.gauge("p2p_owner_congestion_window", "Chunk requests allowed in flight per owner",
+                           lambda: self.get_owner_metric(self.get_congestion_stats(), CONGESTION_WINDOW_KEY),
+                           ("owner",))
+        self.metrics.gauge("p2p_owner_loss_rate", "Share of chunk requests lost per owner",
+                           lambda: self.get_owner_metric(self.get_congestion_stats(), LOSS_RATE_KEY), ("owner",))
+        self.metrics.gauge("p2p_owner_rtt_seconds", "Smoothed round trip time per owner",
+                           lambda: self.get_owner_metric(self.get_owner_stats(), OWNER_RTT_KEY), ("owner",))
+        self.metrics.gauge("p2p_owner_goodput_bytes", "Smoothed goodput per owner, in bytes per second",
+                           lambda: self.get_owner_metric(self.get_owner_stats(), OWNER_GOODPUT_KEY), ("owner",))
+
+    def get_owner_metric(self, stats, key):
+        # { owner: value } from get_owner_stats or get_congestion_stats, leaving out owners without a value yet
+        return dict((owner, owner_stats[key]) for owner, owner_stats in stats.items() if owner_stats[key] is not None)
+
+    def get_num_of_downloads_in_progress(self):
+        with self.download_lock:
+            return len([p for p in self.file_download_process_info if p[CHUNKS_NEEDED]])
 
     def get_directory_files(self):
         # Returns a list of filenames in self.directory
@@ -47,19 +147,20 @@ class Peer(Runner):
             for filename in pack[2]:
                 # Need the full path to check properly
                 full_path = os.path.join(self.directory, filename)
+                if filename == HASH_CACHE_FILENAME or filename == HASH_CACHE_FILENAME + ".tmp":
+                    continue
                 if os.path.isfile(full_path):
                     files.append(filename)
         return files
 
     def format_complete_file(self, filename):
         # Change "filename" to
-        # {"checksum": "checksum", "num_of_chunks": 1, "filename": "test_c"}
+        # {"checksum": "checksum", "num_of_chunks": 1, "chunk_size": 262144, "file_size": 1000, "filename": "test_c"}
         ret = {}
         full_path = os.path.join(self.directory, filename)
-        # Warning: Memory inefficient! Refer to
-        # https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
-        file_checksum = hashlib.md5(open(full_path, 'rb').read()).hexdigest()
-        file_size = os.stat(full_path).st_size  # in bytes
+        stat = os.stat(full_path)
+        file_checksum = self.hash_cache.get_checksum(full_path, stat)
+        file_size = stat.st_size  # in bytes
         leftover_bytes = file_size % self.chunk_size
         if leftover_bytes == 0:
             num_chunks = file_size / self.chunk_size
@@ -67,6 +168,8 @@ class Peer(Runner):
             num_chunks = file_size / self.chunk_size + 1
         ret[MSG_CHECKSUM_KEY] = file_checksum
         ret[MSG_NUM_OF_CHUNKS_KEY] = num_chunks
+        ret[MSG_CHUNK_SIZE_KEY] = self.chunk_size
+        ret[MSG_FILE_SIZE_KEY] = file_size
         ret[MSG_FILENAME_KEY] = filename
         return ret
 
@@ -89,24 +192,82 @@ class Peer(Runner):
             ret.append({MSG_FILENAME_KEY: filename, MSG_CHUNKS_KEY: chunks})
         return ret
 
+    def format_part_files(self, part_bitmaps):
+        # Same format as format_chunks, for the chunks already in .part files
+        ret = []
+        for bitmap_name in part_bitmaps:
+            filename = part_file.get_filename_from_bitmap_name(bitmap_name)
+            chunks = [str(i) for i in part_file.read_owned_chunks(self.directory, filename)]
+            if chunks:
+                ret.append({MSG_FILENAME_KEY: filename, MSG_CHUNKS_KEY: chunks})
+        return ret
+
+    def get_part_file(self, filename):
+        # The open PartFile of a .part download, reopening one left by an
+        # earlier run, or None if there is none
+        with self.part_files_lock:
+            if filename not in self.part_files:
+                existing_part_file = part_file.PartFile.open_existing(self.directory, filename)
+                if existing_part_file is None:
+                    return None
+                self.part_files[filename] = existing_part_file
+            return self.part_files[filename]
+
     def process_dir_listing(self):
         # Process the files in self.directory, and sets the result in
         # self.files and self.chunks
         all_filenames = self.get_directory_files()
-        files = [i for i in all_filenames if i[-6:] != CHUNK_EXTENSION]
+        files = [i for i in all_filenames if i[-6:] != CHUNK_EXTENSION and not part_file.is_part_file(i)
+                 and not i.endswith(COMBINING_EXTENSION)]
         chunks = [i for i in all_filenames if i[-6:] == CHUNK_EXTENSION]
-        self.files = [self.format_complete_file(i) for i in files]
-        self.chunks = self.format_chunks(chunks)
+        part_bitmaps = [i for i in all_filenames if i.endswith(PART_FILE_EXTENSION + PART_BITMAP_EXTENSION)]
+        full_paths = [os.path.join(self.directory, i) for i in files]
+        # Hash new and changed files in parallel, format_complete_file then only hits the cache
+        self.hash_cache.hash_files(full_paths, self.hash_workers)
+        self.files = []
+        for filename in files:
+            try:
+                self.files.append(self.format_complete_file(filename))
+            except (IOError, OSError):
+                # Deleted since the directory was listed, leave it out of this announce
+                continue
+        self.chunks = self.format_chunks(chunks) + self.format_part_files(part_bitmaps)
+        self.hash_cache.prune([os.path.join(self.directory, f[MSG_FILENAME_KEY]) for f in self.files])
+        self.hash_cache.save()
+        # Files may have been changed in place, map them again
+        self.file_cache.invalidate()
 
     def create_info_for_tracker(self):
         # Informs tracker of files in directory, checksum of each file, owned
         # chunks of each file, source port of Peer
         # {
         #     "source_port": port_num,
-        #     "files": [{"checksum": "checksum", "num_of_chunks": 1, "filename": "test_c"}, ...],
-        #     "chunks": [{"chunks": [1, 2, 3, 4, 5], "filename": "test_b"}, ...]
+        #     "files": [{"checksum": "checksum", "num_of_chunks": 1, "chunk_size": 262144, "filename": "test_c"}, ...],
+        #     "chunks": [{"bitfield": "r1,5", "filename": "test_b"}, ...]
+        #     "sequence_number": 1,
         #     "message_type": "INFORM_AND_UPDATE",
         # }
+        info = self.create_source_info()
+        info[MSG_FILES_KEY] = self.files
+        info[MSG_CHUNKS_KEY] = bitfield.encode_file_chunks(self.chunks)
+        info[MSG_SEQUENCE_NUMBER_KEY] = self.announce_sequence_number + 1
+        info[MESSAGE_TYPE_KEY] = INFORM_AND_UPDATE_MESSAGE_TYPE
+        return info
+
+    def create_committed_info_for_tracker(self):
+        # INFORM_AND_UPDATE of what the Trackers last acknowledged, under the
+        # same sequence number, for a shard that lost track of us
+        info = self.create_source_info()
+        info[MSG_FILES_KEY] = self.announced_files.values()
+        info[MSG_CHUNKS_KEY] = bitfield.encode_file_chunks(
+            [{MSG_FILENAME_KEY: filename, MSG_CHUNKS_KEY: list(chunks)}
+             for filename, chunks in self.announced_chunks.items()])
+        info[MSG_SEQUENCE_NUMBER_KEY] = self.announce_sequence_number
+        info[MESSAGE_TYPE_KEY] = INFORM_AND_UPDATE_MESSAGE_TYPE
+        return info
+
+    def create_source_info(self):
+        # Fields the Tracker uses to identify us
         info = {}
         if self.hole_punch:
             info[MSG_SOURCE_IP_KEY] = self.external_ip
@@ -114,37 +275,115 @@ class Peer(Runner):
             info[MSG_SIGNAL_PORT_KEY] = self.external_signal_port
         else:
             info[MSG_SOURCE_PORT_KEY] = self.port
-        info[MSG_FILES_KEY] = self.files
-        info[MSG_CHUNKS_KEY] = self.chunks
-        info[MESSAGE_TYPE_KEY] = INFORM_AND_UPDATE_MESSAGE_TYPE
         return info
 
+    def create_delta_for_tracker(self):
+        # Tells the tracker only what changed since the last successful announce
+        # {
+        #     "source_port": port_num,
+        #     "files_added": [{"checksum": "checksum", "num_of_chunks": 1, "chunk_size": 262144, "filename": "test_c"}, ...],
+        #     "files_removed": ["test_d", ...],
+        #     "chunks_added": [{"bitfield": "r6,2", "filename": "test_b"}, ...],
+        #     "chunks_removed": [{"bitfield": "r1,2", "filename": "test_e"}, ...],
+        #     "sequence_number": 2,
+        #     "message_type": "INFORM_DELTA",
+        # }
+        # Returns None if nothing changed
+        if self.announce_sequence_number == 0:
+            return self.create_info_for_tracker()
+        files = dict((f[MSG_FILENAME_KEY], f) for f in self.files)
+        chunks = dict((c[MSG_FILENAME_KEY], set(c[MSG_CHUNKS_KEY])) for c in self.chunks)
+        announced_files = self.announced_files
+        announced_chunks = self.announced_chunks
+        # A file whose content changed is removed and added again
+        files_added = [f for filename, f in files.items()
+                       if filename not in announced_files
+                       or announced_files[filename][MSG_CHECKSUM_KEY] != f[MSG_CHECKSUM_KEY]]
+        files_removed = [filename for filename, f in announced_files.items()
+                         if filename not in files
+                         or files[filename][MSG_CHECKSUM_KEY] != f[MSG_CHECKSUM_KEY]]
+        chunks_added = []
+        chunks_removed = []
+        for filename in set(chunks.keys() + announced_chunks.keys()):
+            gained = chunks.get(filename, set()) - announced_chunks.get(filename, set())
+            lost = announced_chunks.get(filename, set()) - chunks.get(filename, set())
+            if gained:
+                chunks_added.append({MSG_FILENAME_KEY: filename, MSG_CHUNKS_KEY: list(gained)})
+            if lost:
+                chunks_removed.append({MSG_FILENAME_KEY: filename, MSG_CHUNKS_KEY: list(lost)})
+        if not (files_added or files_removed or chunks_added or chunks_removed):
+            return None
+        delta = self.create_source_info()
+        delta[MSG_FILES_ADDED_KEY] = files_added
+        delta[MSG_FILES_REMOVED_KEY] = files_removed
+        delta[MSG_CHUNKS_ADDED_KEY] = bitfield.encode_file_chunks(chunks_added)
+        delta[MSG_CHUNKS_REMOVED_KEY] = bitfield.encode_file_chunks(chunks_removed)
+        delta[MSG_SEQUENCE_NUMBER_KEY] = self.announce_sequence_number + 1
+        delta[MESSAGE_TYPE_KEY] = INFORM_DELTA_MESSAGE_TYPE
+        return delta
+
+    def commit_announcement(self, message):
+        # The Tracker accepted message, later deltas are relative to what it now knows
+        self.announce_sequence_number = message[MSG_SEQUENCE_NUMBER_KEY]
+        self.announced_files = dict((f[MSG_FILENAME_KEY], f) for f in self.files)
+        self.announced_chunks = dict((c[MSG_FILENAME_KEY], set(c[MSG_CHUNKS_KEY])) for c in self.chunks)
+
+    def get_file_tracker(self, filename):
+        # The Tracker shard responsible for filename
+        return self.tracker_ring.get_node(filename)
+
+    def get_tracker_part(self, message, tracker_id):
+        # The part of an announce about the files that hash to tracker_id
+        if len(self.tracker_ring.nodes) == 1:
+            return message
+        part = dict(message)
+        for key in [MSG_FILES_KEY, MSG_CHUNKS_KEY, MSG_FILES_ADDED_KEY, MSG_CHUNKS_ADDED_KEY, MSG_CHUNKS_REMOVED_KEY]:
+            if key in message:
+                part[key] = [i for i in message[key] if self.get_file_tracker(i[MSG_FILENAME_KEY]) == tracker_id]
+        if MSG_FILES_REMOVED_KEY in message:
+            part[MSG_FILES_REMOVED_KEY] = [filename for filename in message[MSG_FILES_REMOVED_KEY]
+                                           if self.get_file_tracker(filename) == tracker_id]
+        return part
+
+    def send_announcement_to_trackers(self, message, failure_msg="", reply_func=None):
+        """
+        Sends every Tracker shard the part of an INFORM_AND_UPDATE or
+        INFORM_DELTA about the files that hash to it, and our full listing to
+        the shards that ask for a RESYNC
+
+        Every shard gets the message even if none of its files changed, so
+        that all of them expect the same next sequence number. Returns the
+        number of shards that accepted it.
+        """
+        full_message = None
+        num_accepted = 0
+        for tracker_id in self.tracker_ring.nodes:
+            reply = self.send_message_to_tracker(self.get_tracker_part(message, tracker_id), failure_msg=failure_msg,
+                                                 reply_func=reply_func, tracker_id=tracker_id)
+            if reply is not None and reply[MESSAGE_TYPE_KEY] == RESYNC_MESSAGE_TYPE:
+                # The shard missed an update (or forgot us), tell it everything again
+                if full_message is None:
+                    full_message = self.create_info_for_tracker()
+                reply = self.send_message_to_tracker(self.get_tracker_part(full_message, tracker_id),
+                                                     failure_msg=failure_msg, tracker_id=tracker_id)
+            if reply is not None:
+                num_accepted += 1
+        return num_accepted
+
     def send_message_to_tracker(self, message, success_msg="", failure_msg="",
-                                should_exit=False, reply_func=None):
+                                should_exit=False, reply_func=None, tracker_id=None):
         # Helper function whenever Peer needs to send a message to Tracker
-        server_address = (self.tracker_address, self.tracker_port)
-        sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sending_socket.connect(server_address)
+        # Goes to the first Tracker shard unless tracker_id says otherwise
+        if tracker_id is None:
+            tracker_id = self.tracker_ring.nodes[0]
         try:
-            sending_socket.sendall(json.dumps(message))
-
-            # increamentally receiving the JSON data from the tracker
-            data = ''
-            while True:
-                new_bytes = sending_socket.recv(1024)
-                if not new_bytes:
-                    break
-                data += new_bytes
-
-            received_data = json.loads(data)
+            received_data = self.tracker_connections[tracker_id].request(message)
             if reply_func != None:
                 reply_func(received_data)
             if success_msg:
                 print(success_msg)
-            sending_socket.close()
             return received_data
         except:
-            sending_socket.close()
             if failure_msg:
                 print(failure_msg)
             if should_exit:
@@ -159,23 +398,30 @@ class Peer(Runner):
         # Does this by opening a socket to the Tracker and sending the data
         self.process_dir_listing()
         message = self.create_info_for_tracker()
-        self.send_message_to_tracker(
-            message=message,
-            success_msg=REGISTER_PEER_SUCCESS_MESSAGE,
-            failure_msg=REGISTER_PEER_FAILED_MESSAGE,
-            should_exit=True,
-            reply_func=self.get_peer_id
-        )
+        num_accepted = self.send_announcement_to_trackers(message, reply_func=self.get_peer_id)
+        if num_accepted == 0:
+            print(REGISTER_PEER_FAILED_MESSAGE)
+            exit()
+        print(REGISTER_PEER_SUCCESS_MESSAGE)
+        # Shards that missed the listing catch up through RESYNC
+        if num_accepted == len(self.tracker_ring.nodes):
+            self.commit_announcement(message)
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = RecurringThread(HEARTBEAT_INTERVAL, self.send_heartbeat)
 
     def get_available_files(self):
         """
         Asks the Tracker for a list of all files in this network
         """
         message = { MESSAGE_TYPE_KEY: QUERY_LIST_OF_FILES_MESSAGE_TYPE }
-        reply = self.send_message_to_tracker(message)
+        # Every shard only knows its own files
+        filenames = set()
+        for tracker_id in self.tracker_ring.nodes:
+            reply = self.send_message_to_tracker(message, tracker_id=tracker_id)
+            if reply is not None:
+                filenames.update(reply[MSG_FILES_KEY])
         # Format the replies and display to user
-        filenames = sorted(reply[MSG_FILES_KEY])
-        logger.print_available_files(filenames)
+        logger.print_available_files(sorted(filenames))
 
     # def get_peers_with_file(self, filename): # TODO: Remove this? Tracker doesn't reply who has the file
     #     """
@@ -199,23 +445,24 @@ class Peer(Runner):
     #         print("{}: {}".format(k, v))
 
     def signal_listening(self):
-        logger.print_setup_signal_message(self.tracker_address, self.tracker_signal_port)
-        self.signal_socket.sendto(json.dumps({MESSAGE_TYPE_KEY: ACK_MESSAGE_TYPE}), (self.tracker_address, int(self.tracker_signal_port)))
+        # Any shard may have to signal us
+        for tracker_signal_address, tracker_signal_port in self.tracker_signal_addresses.values():
+            logger.print_setup_signal_message(tracker_signal_address, tracker_signal_port)
+            self.signal_socket.sendto(json.dumps({MESSAGE_TYPE_KEY: ACK_MESSAGE_TYPE}),
+                                      (tracker_signal_address, int(tracker_signal_port)))
         while True:
             data_received, _ = self.signal_socket.recvfrom(1024)
             # try:
-            message = json.loads(data_received)
-            if message[MESSAGE_TYPE_KEY] == REQUEST_FILE_CHUNK_SIGNAL_MESSAGE_TYPE:
-                logger.print_receive_signal_message()
-                filename = message[MSG_FILENAME_KEY]
-                chunk_number = message[MSG_CHUNK_NUMBER_KEY]
-                requester_addr_list = message[MSG_RECEIVER_ADDRESS_KEY].split(IP_PORT_DELIMITER)
-                requester_addr = (requester_addr_list[0], int(requester_addr_list[1]))
-                print(requester_addr)
-                file_id = message[MSG_FILE_DOWNLOAD_PROCESS_ID_KEY]
-                self.send_a_file_chunk_to_a_peer(filename, file_id, chunk_number, requester_addr)
-            # except:
-            #     print("There is an error listening to tracker signal")
+            try:
+                message = json.loads(data_received)
+                if message[MESSAGE_TYPE_KEY] == REQUEST_FILE_CHUNK_SIGNAL_MESSAGE_TYPE:
+                    logger.print_receive_signal_message()
+                    requester_addr_list = message[MSG_RECEIVER_ADDRESS_KEY].split(IP_PORT_DELIMITER)
+                    requester_addr = (requester_addr_list[0], int(requester_addr_list[1]))
+                    print(requester_addr)
+                    self.queue_file_chunk_upload(*self.parse_chunk_request(message, requester_addr))
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+                logger.print_malformed_message(e)
 
     def hole_punch_to_peer(self, owner_address):
         # Called when self is behind NAT
@@ -225,52 +472,283 @@ class Peer(Runner):
         self.listening_socket.sendto(json.dumps(message), owner_address)
 
     def listen_func(self):
+        last_timeout_check = time.time()
+        # Every datagram is received into this buffer, chunk data is copied
+        # straight from it into the chunk being reassembled
+        receive_buffer = bytearray(MAX_DATAGRAM_SIZE)
         while True:
             # receive the request info fileInfo{ "fileName": "", "chunkFileName": "", "chunkNumber": int  }
             ## data_from_requester = self.connect.recv(1024) [TCP]
-            data_received, requester_addr = self.listening_socket.recvfrom(1024) #[UDP]
             try:
-                message = json.loads(data_received)
-                if message[MESSAGE_TYPE_KEY] == REQUEST_FILE_CHUNK_MESSAGE_TYPE:
-                    filename = message[MSG_FILENAME_KEY]
-                    chunk_number = message[MSG_CHUNK_NUMBER_KEY]
-                    file_id = message[MSG_FILE_DOWNLOAD_PROCESS_ID_KEY]
-                    self.send_a_file_chunk_to_a_peer(filename, file_id, chunk_number,requester_addr)
-            except: # This is a file chunk that you are receiving
-                print("I have received a file chunk")
-                file_process_id = data_received[0:10].split(ID_DELIMITER)
-                file_download_process = self.file_download_process_info[int(file_process_id[0])]
-                file_name = file_download_process[MSG_FILENAME_KEY]
-                chunk_number = int(file_process_id[1])
-                chunk_file_directory = os.path.join(self.directory, file_name+ "." +str(chunk_number)+CHUNK_EXTENSION)
-                actual_data = data_received[10:]
-                with open(chunk_file_directory, 'wb') as new_chunk_file:
-                    new_chunk_file.write(actual_data)
-                file_download_process[CHUNKS_NEEDED].pop(file_process_id[1])
-                self.file_download_process_info[int(file_process_id[0])] = file_download_process
-                if len(file_download_process[CHUNKS_NEEDED]) == 0:
-                    self.combine_chunks(file_name)
-                else:
-                    chunk_numbers = []
-                    for key in file_download_process[CHUNKS_NEEDED]:
-                        chunk_numbers.append(key)
-                    chunk_owners = file_download_process[CHUNKS_NEEDED][chunk_numbers[0]]
-                    self.download_chunk_from_a_random_peer(chunk_owners, file_name, int(file_process_id[0]), int(chunk_numbers[0]))
-
-    def send_a_file_chunk_to_a_peer(self, filename, file_id, chunk_number, requester_addr):
-        chunk_file_bytes = None
-        if file_utils.has_file(self.directory, filename):
-            with open(os.path.join(self.directory, filename), "rb") as chunk_file:
-                chunk_file.seek(chunk_number * self.chunk_size)
-                chunk_file_bytes = chunk_file.read(self.chunk_size)
+                num_of_bytes, requester_addr = self.listening_socket.recvfrom_into(receive_buffer) #[UDP]
+            except socket.timeout:
+                num_of_bytes = None
+            if time.time() - last_timeout_check >= RETRANSMISSION_CHECK_INTERVAL:
+                self.check_download_timeouts()
+                last_timeout_check = time.time()
+            if num_of_bytes is None:
+                continue
+            try:
+                self.handle_datagram(receive_buffer, num_of_bytes, requester_addr)
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+                # This thread receives everything, one bad datagram must not stop it
+                logger.print_malformed_message(e)
+
+    def handle_datagram(self, receive_buffer, num_of_bytes, requester_addr):
+        if datagram.is_chunk_datagram(receive_buffer, num_of_bytes): # This is a piece of a file chunk that you are receiving
+            self.receive_file_chunk(receive_buffer, num_of_bytes)
+            return
+        message = json.loads(str(receive_buffer[:num_of_bytes]))
+        if message[MESSAGE_TYPE_KEY] == REQUEST_FILE_CHUNK_MESSAGE_TYPE:
+            self.queue_file_chunk_upload(*self.parse_chunk_request(message, requester_addr))
+        elif message[MESSAGE_TYPE_KEY] == PEX_MESSAGE_TYPE:
+            self.receive_peer_exchange(message)
+
+    def parse_chunk_request(self, message, requester_addr):
+        # Arguments of queue_file_chunk_upload for a REQUEST_FILE_CHUNK(_SIGNAL) message,
+        # raises ValueError if the message is malformed
+        filename = message[MSG_FILENAME_KEY]
+        chunk_number = message[MSG_CHUNK_NUMBER_KEY]
+        file_id = message[MSG_FILE_DOWNLOAD_PROCESS_ID_KEY]
+        chunk_size = message.get(MSG_CHUNK_SIZE_KEY, LEGACY_CHUNK_SIZE)
+        missing_datagrams = message.get(MSG_MISSING_DATAGRAMS_KEY)
+        if not isinstance(filename, basestring):
+            raise ValueError("Malformed chunk request filename")
+        for value in [chunk_number, file_id, chunk_size] + list(missing_datagrams or []):
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("Malformed chunk request number " + repr(value))
+        return (filename, file_id, chunk_number, requester_addr, chunk_size,
+                missing_datagrams, message.get(MSG_ATTEMPT_KEY, 0))
+
+    def get_num_of_datagrams(self, chunk_length):
+        # A chunk is sent as this many datagrams of at most DATAGRAM_PAYLOAD_SIZE bytes
+        return max(1, (chunk_length + DATAGRAM_PAYLOAD_SIZE - 1) / DATAGRAM_PAYLOAD_SIZE)
+
+    def receive_file_chunk(self, data_received, num_of_bytes):
+        """
+        Reassembles the datagrams of a chunk, and writes the chunk to disk once
+        all of them have arrived
+
+        Datagrams lost on the way are asked for again as soon as the owner has
+        sent the last one of the request, rather than after a timeout.
+        """
+        header = datagram.parse_chunk_datagram(data_received, num_of_bytes)
+        if header is None:
+            # Corrupted or truncated, the missing datagram gets requested again
+            return
+        file_id, chunk_number, offset, chunk_length, payload_length, attempt = header
+        payload = memoryview(data_received)[DATAGRAM_HEADER_SIZE:DATAGRAM_HEADER_SIZE + payload_length]
+        self.bytes_received_metric.inc(payload_length)
+        requests = []
+        is_complete = False
+        with self.download_lock:
+            if file_id >= len(self.file_download_process_info):
+                return
+            file_download_process = self.file_download_process_info[file_id]
+            if chunk_number not in file_download_process[CHUNKS_NEEDED]:
+                # Duplicate of a chunk that has already been written
+                return
+            if not self.is_valid_chunk_datagram(file_download_process, chunk_number, offset,
+                                                chunk_length, payload_length):
+                # Does not fit the chunk it claims to be a piece of
+                return
+            partial_chunks = file_download_process[PARTIAL_CHUNKS]
+            if chunk_number not in partial_chunks:
+                partial_chunks[chunk_number] = {PARTIAL_CHUNK_DATA: bytearray(chunk_length),
+                                                PARTIAL_CHUNK_RECEIVED: set()}
+            partial_chunk = partial_chunks[chunk_number]
+            partial_chunk[PARTIAL_CHUNK_DATA][offset:offset + payload_length] = payload
+            datagram_number = offset / DATAGRAM_PAYLOAD_SIZE
+            partial_chunk[PARTIAL_CHUNK_RECEIVED].add(datagram_number)
+            num_of_datagrams = self.get_num_of_datagrams(chunk_length)
+            request = file_download_process[CHUNKS_IN_FLIGHT].get(chunk_number)
+            if request is not None:
+                # The owner is making progress, hold off the retransmission timer
+                request[REQUEST_LAST_ACTIVITY_KEY] = time.time()
+                self.record_request_rtt(request, attempt)
+            if len(partial_chunk[PARTIAL_CHUNK_RECEIVED]) < num_of_datagrams:
+                if request is not None and self.is_last_datagram(request, datagram_number, attempt, num_of_datagrams):
+                    # The owner has sent everything we asked for, what is
+                    # missing got lost on the way
+                    self.chunk_retransmits_metric.inc()
+                    requests.append(self.start_chunk_request(file_id, chunk_number, request[REQUEST_OWNER_KEY],
+                                                             request[REQUEST_ATTEMPTS_KEY] + 1))
+            else:
+                self.write_chunk(file_download_process, chunk_number, partial_chunk[PARTIAL_CHUNK_DATA])
+                is_complete = len(file_download_process[CHUNKS_NEEDED]) == 0
+                requests = self.fill_download_windows()
+        self.send_chunk_requests(requests)
+        if is_complete:
+            self.combine_chunks(file_download_process[MSG_FILENAME_KEY], file_download_process[MSG_NUM_OF_CHUNKS_KEY],
+                                file_download_process[MSG_CHUNK_SIZE_KEY])
+
+    def is_valid_chunk_datagram(self, file_download_process, chunk_number, offset, chunk_length, payload_length):
+        """
+        Whether a datagram's header agrees with the download, checked before
+        anything is allocated for the chunk
+
+        Every chunk but the last one is chunk_size long, the last one holds
+        the rest of the file. Older trackers do not tell us the file size, the
+        last chunk can then be any length up to chunk_size as long as all of
+        its datagrams agree on it. Each datagram carries all the chunk data
+        it has room for, from an offset on a datagram boundary. Must be
+        called with self.download_lock held.
+        """
+        chunk_size = file_download_process[MSG_CHUNK_SIZE_KEY]
+        file_size = file_download_process[MSG_FILE_SIZE_KEY]
+        partial_chunk = file_download_process[PARTIAL_CHUNKS].get(chunk_number)
+        if partial_chunk is not None:
+            if chunk_length != len(partial_chunk[PARTIAL_CHUNK_DATA]):
+                return False
+        elif chunk_number < file_download_process[MSG_NUM_OF_CHUNKS_KEY] - 1:
+            if chunk_length != chunk_size:
+                return False
+        elif file_size is not None:
+            if chunk_length != file_size - chunk_number * chunk_size:
+                return False
+        elif not 0 < chunk_length <= chunk_size:
+            return False
+        return (offset % DATAGRAM_PAYLOAD_SIZE == 0 and offset < chunk_length
+                and payload_length == min(DATAGRAM_PAYLOAD_SIZE, chunk_length - offset))
+
+    def write_chunk(self, file_download_process, chunk_number, chunk_data):
+        # Stores a chunk whose datagrams have all arrived, and closes its request
+        # Must be called with self.download_lock held
+        print("I have received a file chunk")
+        file_name = file_download_process[MSG_FILENAME_KEY]
+        download_part_file = self.part_files.get(file_name) if self.preallocate else None
+        if download_part_file is not None:
+            download_part_file.write_chunk(chunk_number, chunk_data)
         else:
-            with open(os.path.join(self.directory, filename + "." + str(chunk_number) + CHUNK_EXTENSION)) as chunk_file:
-                chunk_file_bytes = chunk_file.read(self.chunk_size)
-        bytes_array = bytearray(str(file_id) + ID_DELIMITER + str(chunk_number))
-        padding = 10 - len(bytes_array)
-        for _ in range(padding):
-            bytes_array.append(ID_DELIMITER)
-        self.listening_socket.sendto(bytes_array + chunk_file_bytes, requester_addr)
+            chunk_file_directory = os.path.join(self.directory, file_name+ "." +str(chunk_number)+CHUNK_EXTENSION)
+            with open(chunk_file_directory, 'wb') as new_chunk_file:
+                new_chunk_file.write(chunk_data)
+        file_download_process[PARTIAL_CHUNKS].pop(chunk_number)
+        self.chunks_received_metric.inc()
+        file_download_process[CHUNKS_NEEDED].pop(chunk_number)
+        file_download_process[CHUNK_FAILED_OWNERS].pop(chunk_number, None)
+        request = file_download_process[CHUNKS_IN_FLIGHT].pop(chunk_number, None)
+        if request is not None:
+            owner = request[REQUEST_OWNER_KEY]
+            self.get_owner_congestion(owner).on_chunk_received(request[REQUEST_RTT_KEY])
+            self.owner_stats.record_chunk(owner, len(chunk_data), time.time() - request[REQUEST_SENT_AT_KEY],
+                                          request[REQUEST_RTT_KEY])
+            self.chunk_download_seconds_metric.observe(time.time() - request[REQUEST_SENT_AT_KEY])
+
+    def get_attempt_tag(self, attempts):
+        # What owners echo in the datagrams answering a request's attempt,
+        # 0 is what owners that echo nothing send
+        return (attempts - 1) % 255 + 1
+
+    def record_request_rtt(self, request, attempt):
+        """
+        Takes an RTT sample from the first datagram answering the request's
+        latest attempt
+
+        Karn's algorithm: without the attempt echoed by the owner, only a
+        request that was never retransmitted gives an unambiguous sample.
+        Must be called with self.download_lock held.
+        """
+        if request[REQUEST_RTT_KEY] is not None:
+            return
+        if attempt != self.get_attempt_tag(request[REQUEST_ATTEMPTS_KEY]):
+            if attempt != 0 or request[REQUEST_ATTEMPTS_KEY] != 1:
+                return
+        request[REQUEST_RTT_KEY] = time.time() - request[REQUEST_SENT_AT_KEY]
+        self.get_owner_rtt(request[REQUEST_OWNER_KEY]).add_sample(request[REQUEST_RTT_KEY])
+
+    def is_last_datagram(self, request, datagram_number, attempt, num_of_datagrams):
+        # Whether a datagram is the last one the owner sends for the request's latest attempt
+        if attempt not in (0, self.get_attempt_tag(request[REQUEST_ATTEMPTS_KEY])):
+            # Left over from an earlier attempt
+            return False
+        last_datagram = request[REQUEST_LAST_DATAGRAM_KEY]
+        if last_datagram is None:
+            last_datagram = num_of_datagrams - 1
+        return datagram_number == last_datagram
+
+    def queue_file_chunk_upload(self, filename, file_id, chunk_number, requester_addr, chunk_size,
+                                missing_datagrams=None, attempt=0):
+        # Hands the request to the upload workers, requests beyond what a
+        # requester may have queued are dropped and will be retransmitted
+        self.upload_scheduler.submit(requester_addr, (file_id, chunk_number),
+                                     (filename, file_id, chunk_number, requester_addr, chunk_size,
+                                      missing_datagrams, attempt))
+
+    def send_a_file_chunk_to_a_peer(self, filename, file_id, chunk_number, requester_addr, chunk_size,
+                                    missing_datagrams=None, attempt=0):
+        """
+        Sends a chunk as a series of datagrams, or only the datagrams listed in
+        missing_datagrams when the requester already has the rest. Every
+        datagram carries the attempt of the request it answers.
+        """
+        chunk_file_bytes = self.file_cache.read(os.path.join(self.directory, filename),
+                                                chunk_number * chunk_size, chunk_size)
+        if chunk_file_bytes is None:
+            serving_part_file = self.get_part_file(filename)
+            if serving_part_file is not None and serving_part_file.has_chunk(chunk_number):
+                chunk_file_bytes = serving_part_file.read_chunk(chunk_number)
+            else:
+                chunk_file_directory = os.path.join(self.directory, filename + "." + str(chunk_number) + CHUNK_EXTENSION)
+                chunk_file_bytes = self.file_cache.read(chunk_file_directory, 0, chunk_size)
+        if chunk_file_bytes is None:
+            # We do not have this chunk (any more), the requester will try someone else
+            return
+        if missing_datagrams is None:
+            missing_datagrams = range(self.get_num_of_datagrams(len(chunk_file_bytes)))
+        sender = datagram.ChunkDatagramSender(self.listening_socket, file_id, chunk_number, chunk_file_bytes, attempt)
+        for datagram_number in missing_datagrams:
+            if self.upload_rate_limiter is not None:
+                self.upload_rate_limiter.consume(DATAGRAM_HEADER_SIZE + sender.get_payload_length(datagram_number))
+            sender.send(datagram_number, requester_addr)
+            self.bytes_sent_metric.inc(sender.get_payload_length(datagram_number))
+        self.chunks_served_metric.inc()
+        # The requester can serve this chunk too now, and may not know who else can
+        requester = requester_addr[0] + IP_PORT_DELIMITER + str(requester_addr[1])
+        self.peer_exchange.record(filename, requester, [chunk_number])
+        pex_message = self.peer_exchange.create_message(filename, file_id, requester)
+        if pex_message is not None:
+            self.listening_socket.sendto(json.dumps(pex_message), requester_addr)
+
+    def receive_peer_exchange(self, message):
+        """
+        Adds the owners listed in a PEX message to the download it is about,
+        and puts any that can take requests to use right away
+        """
+        if not is_valid_pex_message(message):
+            raise ValueError("Malformed PEX message")
+        file_id = message[MSG_FILE_DOWNLOAD_PROCESS_ID_KEY]
+        with self.download_lock:
+            if file_id >= len(self.file_download_process_info):
+                return
+            file_download_process = self.file_download_process_info[file_id]
+            if file_download_process[MSG_FILENAME_KEY] != message[MSG_FILENAME_KEY]:
+                return
+            self.peer_exchange.record_reply(message, file_download_process[MSG_NUM_OF_CHUNKS_KEY])
+            if not file_download_process[CHUNKS_NEEDED]:
+                return
+            if not self.add_exchanged_owners(file_download_process):
+                return
+            file_download_process[PIECE_PICKER].update(file_download_process[CHUNKS_NEEDED],
+                                                       file_download_process[CHUNKS_IN_FLIGHT])
+            requests = self.fill_download_window(file_id)
+        self.send_chunk_requests(requests)
+
+    def add_exchanged_owners(self, file_download_process):
+        # Adds the owners the peer exchange knows of to the chunks a download
+        # still needs, returns whether any chunk gained an owner
+        # Must be called with self.download_lock held
+        chunks_needed = file_download_process[CHUNKS_NEEDED]
+        has_new_owners = False
+        for owner, chunks in self.peer_exchange.get_owners(file_download_process[MSG_FILENAME_KEY]).items():
+            if chunks is None:
+                chunks = chunks_needed.keys()
+            for chunk_number in chunks:
+                chunk_owners = chunks_needed.get(chunk_number)
+                if chunk_owners is not None and owner not in chunk_owners:
+                    chunk_owners.append(owner)
+                    has_new_owners = True
+        return has_new_owners
 
     def initiate_download(self, filename):
         """
@@ -285,89 +763,417 @@ class Peer(Runner):
             return;
 
         # query the tracker on who has the chucks to the file by supplying the filename / checksum
+        reply = self.query_file(filename)
+        if reply is None:
+            return
+
+        # Create process info for the file downloading
+        if self.preallocate:
+            download_part_file = self.open_part_file(filename, reply)
+            available_chunks = download_part_file.get_owned_chunks()
+        else:
+            available_chunks = file_utils.get_all_chunk_number_available(self.directory, filename)
+        chunks_needed = {}
+        for chunk_number, chunk_owners in self.get_chunk_owners_from_reply(reply).items():
+            if chunk_number not in available_chunks:
+                chunks_needed[chunk_number] = chunk_owners # { chunk#: [ (ip:port), (ip:port), ... ], chunk#: [ ... ], ... }
+
+        num_of_chunks = reply[MSG_NUM_OF_CHUNKS_KEY]
+        chunk_size = reply.get(MSG_CHUNK_SIZE_KEY, LEGACY_CHUNK_SIZE)
+        if not chunks_needed: # if all the chunks are available in our directory, just assemble them and Done!
+            self.combine_chunks(filename, num_of_chunks, chunk_size)
+            return
+
+        file_download_info = {CHUNKS_NEEDED: chunks_needed, CHUNKS_IN_FLIGHT: {}, CHUNK_FAILED_OWNERS: {},
+                              PARTIAL_CHUNKS: {}, MSG_FILENAME_KEY: reply[MSG_FILENAME_KEY],
+                              MSG_NUM_OF_CHUNKS_KEY: num_of_chunks, MSG_CHUNK_SIZE_KEY: chunk_size,
+                              MSG_FILE_SIZE_KEY: reply.get(MSG_FILE_SIZE_KEY)}
+        with self.download_lock:
+            # Owners other peers told us about that the Tracker left out of its sample
+            self.add_exchanged_owners(file_download_info)
+            file_download_info[PIECE_PICKER] = PiecePicker(chunks_needed, {})
+            file_id = len(self.file_download_process_info)
+            self.file_download_process_info.append(file_download_info)
+            # Kick off the first window of chunk downloads
+            requests = self.fill_download_window(file_id)
+        self.send_chunk_requests(requests)
+        if self.availability_refresh_thread is None:
+            self.availability_refresh_thread = RecurringThread(AVAILABILITY_REFRESH_INTERVAL,
+                                                               self.refresh_chunk_availability)
+
+    def open_part_file(self, filename, reply):
+        # Creates (or picks up where an earlier run left) the .part file of a download
+        num_of_chunks = reply[MSG_NUM_OF_CHUNKS_KEY]
+        chunk_size = reply.get(MSG_CHUNK_SIZE_KEY, LEGACY_CHUNK_SIZE)
+        with self.part_files_lock:
+            existing_part_file = self.part_files.pop(filename, None)
+            if existing_part_file is not None:
+                existing_part_file.close()
+            self.part_files[filename] = part_file.PartFile(self.directory, filename, num_of_chunks, chunk_size)
+            return self.part_files[filename]
+
+    def query_file(self, filename, chunk_range=None):
+        """
+        Asks the Tracker for up to MAX_PEERS_PER_CHUNK owners of each chunk
+        of a file, or only of the chunks in chunk_range ([first, last))
+
+        Returns the QUERY_FILE_REPLY, or None if the Tracker does not know the file.
+        """
         message = {}
         message[MESSAGE_TYPE_KEY] = QUERY_FILE_MESSAGE_TYPE
         message[MSG_FILENAME_KEY] = filename
-        reply = self.send_message_to_tracker(message)
+        message[MSG_ENCODING_KEY] = BITFIELD_ENCODING
+        message[MSG_MAX_PEERS_KEY] = MAX_PEERS_PER_CHUNK
+        if chunk_range is not None:
+            message[MSG_FIRST_CHUNK_KEY], message[MSG_LAST_CHUNK_KEY] = chunk_range
+        reply = self.send_message_to_tracker(message, tracker_id=self.get_file_tracker(filename))
 
         # Handle "file not found"
         if reply[MESSAGE_TYPE_KEY] == QUERY_FILE_ERROR_MESSAGE_TYPE:
             print(reply["error"])
-            return
+            return None
 
-        # Update list of peers known to be behind NAT
-        self.known_peers_behind_nat = reply[MSG_PEER_BEHIND_NAT_KEY]
+        # Update list of peers known to be behind NAT, the reply only
+        # mentions the owners it lists
+        self.known_peers_behind_nat = list(set(self.known_peers_behind_nat) | set(reply[MSG_PEER_BEHIND_NAT_KEY]))
+        with self.download_lock:
+            self.owner_stats.set_peers_behind_nat(self.known_peers_behind_nat)
+        self.peer_exchange.record_reply(reply, reply[MSG_NUM_OF_CHUNKS_KEY])
+        return reply
 
-        # Create process info for the file downloading
-        available_chunks = file_utils.get_all_chunk_number_available(self.directory, filename)
-        chunks_needed = {}
-        chunk_numbers = []
-        for key, chunkOwners in reply[MSG_CHUNKS_KEY].items():
-            if int(key) not in available_chunks:
-                chunks_needed[key] = chunkOwners # { chunk#: [ (ip:port), (ip:port), ... ], chunk#: [ ... ], ... }
-                chunk_numbers.append(key)
-
-        if not chunk_numbers: # if all the chunks are available in our directory, just assemble them and Done!
-            self.combine_chunks(filename)
-            return
+    def get_chunk_owners_from_reply(self, reply):
+        # Returns { chunk#: [owner, ...] } for every chunk of the file, with an
+        # empty list for chunks that currently have no owner
+        num_of_chunks = reply[MSG_NUM_OF_CHUNKS_KEY]
+        if MSG_BITFIELDS_KEY not in reply:
+            chunk_owners = dict((i, []) for i in range(num_of_chunks))
+            for key, owners in reply[MSG_CHUNKS_KEY].items():
+                chunk_owners[int(key)] = owners
+            return chunk_owners
+        seeders = reply[MSG_SEEDERS_KEY]
+        chunk_owners = dict((i, list(seeders)) for i in range(num_of_chunks))
+        for owner, encoded_chunks in reply[MSG_BITFIELDS_KEY].items():
+            for chunk_number in bitfield.decode(encoded_chunks, num_of_chunks):
+                chunk_owners[chunk_number].append(owner)
+        return chunk_owners
+
+    def refresh_chunk_availability(self):
+        """
+        Re-queries the Tracker for every unfinished download that has run out
+        of owners for some chunk, so that the piece picker works on fresh
+        availability and new owners are put to use
+
+        Downloads that peer exchange keeps supplied with owners leave the
+        Tracker alone.
+        """
+        with self.download_lock:
+            # Only the chunks still needed are of interest
+            active_downloads = [(file_id, file_download_process[MSG_FILENAME_KEY],
+                                 (min(file_download_process[CHUNKS_NEEDED]), max(file_download_process[CHUNKS_NEEDED]) + 1))
+                                for file_id, file_download_process in enumerate(self.file_download_process_info)
+                                if file_download_process[CHUNKS_NEEDED]
+                                and self.is_missing_owners(file_download_process)]
+        for file_id, filename, chunk_range in active_downloads:
+            reply = self.query_file(filename, chunk_range)
+            if reply is None:
+                continue
+            chunk_owners = self.get_chunk_owners_from_reply(reply)
+            with self.download_lock:
+                file_download_process = self.file_download_process_info[file_id]
+                chunks_needed = file_download_process[CHUNKS_NEEDED]
+                for chunk_number in chunks_needed:
+                    chunks_needed[chunk_number] = chunk_owners.get(chunk_number, [])
+                self.add_exchanged_owners(file_download_process)
+                file_download_process[PIECE_PICKER].update(chunks_needed, file_download_process[CHUNKS_IN_FLIGHT])
+                requests = self.fill_download_window(file_id)
+            self.send_chunk_requests(requests)
+
+    def is_missing_owners(self, file_download_process):
+        # Whether some chunk still needed has no owner that has not already failed us
+        # Must be called with self.download_lock held
+        for chunk_number, chunk_owners in file_download_process[CHUNKS_NEEDED].items():
+            failed_owners = file_download_process[CHUNK_FAILED_OWNERS].get(chunk_number, {})
+            if not [o for o in chunk_owners if failed_owners.get(o, 0) < MAX_CHUNK_ATTEMPTS_PER_OWNER]:
+                return True
+        return False
+
+    def fill_download_windows(self):
+        """
+        Fills the window of every unfinished download, oldest first
+
+        Owners' congestion windows are shared by all downloads, so a chunk
+        arriving for one download can make room for the requests another
+        one is waiting to send. Must be called with self.download_lock held.
+        """
+        requests = []
+        total_owner_load = self.get_total_owner_load()
+        for file_id, file_download_process in enumerate(self.file_download_process_info):
+            if file_download_process[CHUNKS_NEEDED]:
+                requests += self.fill_download_window(file_id, total_owner_load)
+        return requests
+
+    def fill_download_window(self, file_id, total_owner_load=None):
+        """
+        Picks chunks to request, rarest first, until the download has
+        self.download_window_size requests outstanding, spreading them across
+        the owners of each chunk
 
-        file_download_info = {CHUNKS_NEEDED: chunks_needed, MSG_FILENAME_KEY: reply[MSG_FILENAME_KEY]}
-        file_id = len(self.file_download_process_info)
-        self.file_download_process_info.append(file_download_info)
-        chunk_owners = chunks_needed[chunk_numbers[0]]
-        # Kick off the first chunk download
-        self.download_chunk_from_a_random_peer(chunk_owners, filename, file_id, int(chunk_numbers[0]))
-
-    def download_chunk_from_a_random_peer(self, chunk_owners, filename, file_id, chunk_number):
-        random_host_index = randint(0, len(chunk_owners) - 1)
-        random_host_ip_and_port = chunk_owners[random_host_index].split(IP_PORT_DELIMITER)
-	print(random_host_ip_and_port)
-        owner_address = (random_host_ip_and_port[0], int(random_host_ip_and_port[1]))
+        Must be called with self.download_lock held. Returns a list of
+        (owner, filename, file_id, chunk_number, chunk_size, missing_datagrams,
+        attempt) to be sent with send_chunk_requests once the lock is released.
+        """
+        file_download_process = self.file_download_process_info[file_id]
+        chunks_needed = file_download_process[CHUNKS_NEEDED]
+        chunks_in_flight = file_download_process[CHUNKS_IN_FLIGHT]
+        piece_picker = file_download_process[PIECE_PICKER]
+        owner_load = self.get_owner_load(file_download_process)
+        if total_owner_load is None:
+            total_owner_load = self.get_total_owner_load()
+        requests = []
+        congested_chunks = []
+        while len(chunks_in_flight) < self.download_window_size and len(congested_chunks) < MAX_CONGESTED_CHUNKS_SKIPPED:
+            chunk_number = piece_picker.next_chunk(chunks_needed, chunks_in_flight)
+            if chunk_number is None:
+                break
+            request = self.assign_chunk_request(file_id, chunk_number, owner_load, total_owner_load, 1)
+            if request is None:
+                # Every owner of this chunk has a full congestion window
+                congested_chunks.append(chunk_number)
+                continue
+            requests.append(request)
+        piece_picker.requeue(congested_chunks)
+        return requests
+
+    def get_owner_load(self, file_download_process):
+        # Number of outstanding requests per owner for this download
+        owner_load = {}
+        for request in file_download_process[CHUNKS_IN_FLIGHT].values():
+            owner = request[REQUEST_OWNER_KEY]
+            owner_load[owner] = owner_load.get(owner, 0) + 1
+        return owner_load
+
+    def get_total_owner_load(self):
+        # Number of outstanding requests per owner across all downloads
+        total_owner_load = {}
+        for file_download_process in self.file_download_process_info:
+            for owner, load in self.get_owner_load(file_download_process).items():
+                total_owner_load[owner] = total_owner_load.get(owner, 0) + load
+        return total_owner_load
+
+    def assign_chunk_request(self, file_id, chunk_number, owner_load, total_owner_load, attempts):
+        """
+        Chooses an owner for chunk_number and records the request as in flight
+
+        Owners that already timed out MAX_CHUNK_ATTEMPTS_PER_OWNER times for
+        this chunk are skipped while any other owner remains. Returns None
+        if every owner already has its congestion window full.
+        """
+        file_download_process = self.file_download_process_info[file_id]
+        chunk_owners = file_download_process[CHUNKS_NEEDED][chunk_number]
+        failed_owners = file_download_process[CHUNK_FAILED_OWNERS].get(chunk_number, {})
+        candidates = [o for o in chunk_owners if failed_owners.get(o, 0) < MAX_CHUNK_ATTEMPTS_PER_OWNER]
+        if not candidates:
+            # Every owner has failed us, start over with all of them
+            file_download_process[CHUNK_FAILED_OWNERS].pop(chunk_number, None)
+            candidates = chunk_owners
+        candidates = [o for o in candidates
+                      if total_owner_load.get(o, 0) < self.get_owner_congestion(o).get_allowed_requests()]
+        if not candidates:
+            return None
+        # Mostly the fast and reliable owners, sometimes any of them
+        owner = self.owner_stats.choose_owner(candidates, owner_load)
+        owner_load[owner] = owner_load.get(owner, 0) + 1
+        total_owner_load[owner] = total_owner_load.get(owner, 0) + 1
+        return self.start_chunk_request(file_id, chunk_number, owner, attempts)
+
+    def start_chunk_request(self, file_id, chunk_number, owner, attempts):
+        """
+        Records the request of chunk_number from owner as in flight, replacing
+        any earlier one, and returns it as (owner, filename, file_id,
+        chunk_number, chunk_size, missing_datagrams, attempt)
+
+        Must be called with self.download_lock held.
+        """
+        file_download_process = self.file_download_process_info[file_id]
+        # Only ask again for the datagrams of the chunk that never arrived
+        missing_datagrams = None
+        partial_chunk = file_download_process[PARTIAL_CHUNKS].get(chunk_number)
+        if partial_chunk is not None:
+            num_of_datagrams = self.get_num_of_datagrams(len(partial_chunk[PARTIAL_CHUNK_DATA]))
+            missing_datagrams = [i for i in range(num_of_datagrams)
+                                 if i not in partial_chunk[PARTIAL_CHUNK_RECEIVED]][:MAX_MISSING_DATAGRAMS_PER_REQUEST]
+        now = time.time()
+        file_download_process[CHUNKS_IN_FLIGHT][chunk_number] = {
+            REQUEST_OWNER_KEY: owner,
+            REQUEST_SENT_AT_KEY: now,
+            REQUEST_LAST_ACTIVITY_KEY: now,
+            REQUEST_ATTEMPTS_KEY: attempts,
+            # Round trip time to the first datagram answering this attempt
+            REQUEST_RTT_KEY: None,
+            # The datagram the owner sends last, None for the last one of the chunk
+            REQUEST_LAST_DATAGRAM_KEY: missing_datagrams[-1] if missing_datagrams else None
+        }
+        return (owner, file_download_process[MSG_FILENAME_KEY], file_id, chunk_number,
+                file_download_process[MSG_CHUNK_SIZE_KEY], missing_datagrams, self.get_attempt_tag(attempts))
+
+    def get_owner_rtt(self, owner):
+        if owner not in self.owner_rtt:
+            self.owner_rtt[owner] = RttEstimator(INITIAL_RTO, MIN_RTO, MAX_RTO)
+        return self.owner_rtt[owner]
+
+    def get_owner_congestion(self, owner):
+        if owner not in self.owner_congestion:
+            self.owner_congestion[owner] = CongestionController(INITIAL_CONGESTION_WINDOW, MIN_CONGESTION_WINDOW,
+                                                                MAX_CONGESTION_WINDOW)
+        return self.owner_congestion[owner]
+
+    def get_owner_stats(self):
+        # { owner: {"rtt": 0.1, "goodput": 1000000.0, "failures": 0, "behind_nat": False}, ... }
+        with self.download_lock:
+            return dict((owner, dict(stats)) for owner, stats in self.owner_stats.owners.items())
+
+    def get_congestion_stats(self):
+        # { owner: {"window": 4.5, "loss_rate": 0.01}, ... }
+        with self.download_lock:
+            return dict((owner, {CONGESTION_WINDOW_KEY: congestion.window, LOSS_RATE_KEY: congestion.loss_rate})
+                        for owner, congestion in self.owner_congestion.items())
+
+    def check_download_timeouts(self):
+        """
+        Re-requests only the chunks whose request outlived the owner's
+        retransmission timeout, moving to another owner after repeated losses
+        """
+        now = time.time()
+        requests = []
+        with self.download_lock:
+            backed_off_owners = set()
+            for file_id, file_download_process in enumerate(self.file_download_process_info):
+                chunks_in_flight = file_download_process[CHUNKS_IN_FLIGHT]
+                timed_out = [chunk_number for chunk_number, request in chunks_in_flight.items()
+                             if now - request[REQUEST_LAST_ACTIVITY_KEY] > self.get_owner_rtt(request[REQUEST_OWNER_KEY]).rto]
+                if not timed_out:
+                    continue
+                attempts = {}
+                for chunk_number in timed_out:
+                    request = chunks_in_flight.pop(chunk_number)
+                    owner = request[REQUEST_OWNER_KEY]
+                    attempts[chunk_number] = request[REQUEST_ATTEMPTS_KEY] + 1
+                    failed_owners = file_download_process[CHUNK_FAILED_OWNERS].setdefault(chunk_number, {})
+                    failed_owners[owner] = failed_owners.get(owner, 0) + 1
+                    if chunk_number not in file_download_process[PARTIAL_CHUNKS]:
+                        # Nothing came back at all, as opposed to a chunk that
+                        # arrived short of a few datagrams
+                        self.get_owner_congestion(owner).on_request_lost(self.get_owner_rtt(owner).rto)
+                        self.owner_stats.record_failure(owner)
+                    self.chunk_retransmits_metric.inc()
+                    # Back off once per owner no matter how many of its requests were lost
+                    if owner not in backed_off_owners:
+                        self.get_owner_rtt(owner).backoff()
+                        backed_off_owners.add(owner)
+                    logger.print_chunk_timeout_message(file_download_process[MSG_FILENAME_KEY], chunk_number, owner)
+                owner_load = self.get_owner_load(file_download_process)
+                total_owner_load = self.get_total_owner_load()
+                for chunk_number in timed_out:
+                    if not file_download_process[CHUNKS_NEEDED][chunk_number]:
+                        # No owner left, the next availability refresh picks it up again
+                        continue
+                    request = self.assign_chunk_request(file_id, chunk_number, owner_load, total_owner_load,
+                                                        attempts[chunk_number])
+                    if request is None:
+                        # Leave it to fill_download_window once an owner has room again
+                        file_download_process[PIECE_PICKER].requeue([chunk_number])
+                        continue
+                    requests.append(request)
+        self.send_chunk_requests(requests)
+
+    def send_chunk_requests(self, requests):
+        for owner, filename, file_id, chunk_number, chunk_size, missing_datagrams, attempt in requests:
+            self.download_chunk_from_peer(owner, filename, file_id, chunk_number, chunk_size, missing_datagrams,
+                                          attempt)
+
+    def download_chunk_from_peer(self, owner, filename, file_id, chunk_number, chunk_size, missing_datagrams,
+                                 attempt):
+        self.chunks_requested_metric.inc()
+        owner_ip_and_port = owner.split(IP_PORT_DELIMITER)
+        owner_address = (owner_ip_and_port[0], int(owner_ip_and_port[1]))
         if self.hole_punch:
             self.hole_punch_to_peer(owner_address)
-        if chunk_owners[random_host_index] in self.known_peers_behind_nat: # The peer you wanted to get the file chunk from is behind NAT
+        if owner in self.known_peers_behind_nat: # The peer you wanted to get the file chunk from is behind NAT
             logger.print_peer_behind_nat_message()
-            self.send_signal_to_tracker_for_file_chunk(owner_address, filename, file_id, chunk_number)
+            self.send_signal_to_tracker_for_file_chunk(owner_address, filename, file_id, chunk_number,
+                                                       chunk_size, missing_datagrams, attempt)
         else: # The peer you wanted to get the file chunk from is not behind NAT
-            self.request_file_chunk_from_peer(owner_address, filename, file_id, chunk_number)
+            self.request_file_chunk_from_peer(owner_address, filename, file_id, chunk_number,
+                                              chunk_size, missing_datagrams, attempt)
 
-    def send_signal_to_tracker_for_file_chunk(self, owner_address, filename, file_download_process_id, chunk_number):
+    def send_signal_to_tracker_for_file_chunk(self, owner_address, filename, file_download_process_id, chunk_number,
+                                              chunk_size, missing_datagrams=None, attempt=None):
         message = {}
         message[MESSAGE_TYPE_KEY] = REQUEST_FILE_CHUNK_NAT_MESSAGE_TYPE
         message[MSG_FILENAME_KEY] = filename
         message[MSG_FILE_DOWNLOAD_PROCESS_ID_KEY] = file_download_process_id
         message[MSG_CHUNK_NUMBER_KEY] = chunk_number
+        message[MSG_CHUNK_SIZE_KEY] = chunk_size
+        if missing_datagrams is not None:
+            message[MSG_MISSING_DATAGRAMS_KEY] = missing_datagrams
+        if attempt is not None:
+            message[MSG_ATTEMPT_KEY] = attempt
         if self.hole_punch:
             message[MSG_RECEIVER_ADDRESS_KEY] = self.external_ip + IP_PORT_DELIMITER + str(self.external_port)
         else:
             message[MSG_RECEIVER_ADDRESS_KEY] = self.external_ip + IP_PORT_DELIMITER + str(self.port)
         message[MSG_OWNER_ADDRESS_KEY] = owner_address[0] + IP_PORT_DELIMITER + str(owner_address[1])
-        self.send_message_to_tracker(message)
+        self.send_message_to_tracker(message, tracker_id=self.get_file_tracker(filename))
 
-    def request_file_chunk_from_peer(self, owner_address, filename, file_download_process_id, chunk_number):
+    def request_file_chunk_from_peer(self, owner_address, filename, file_download_process_id, chunk_number,
+                                     chunk_size, missing_datagrams=None, attempt=None):
         message = {}
         message[MESSAGE_TYPE_KEY] = REQUEST_FILE_CHUNK_MESSAGE_TYPE
         message[MSG_FILE_DOWNLOAD_PROCESS_ID_KEY] = file_download_process_id
         message[MSG_FILENAME_KEY] = filename
         message[MSG_CHUNK_NUMBER_KEY] = chunk_number
+        message[MSG_CHUNK_SIZE_KEY] = chunk_size
+        if missing_datagrams is not None:
+            message[MSG_MISSING_DATAGRAMS_KEY] = missing_datagrams
+        if attempt is not None:
+            message[MSG_ATTEMPT_KEY] = attempt
         self.listening_socket.sendto(json.dumps(message), owner_address)
 
-    def combine_chunks(self, filename):
+    def combine_chunks(self, filename, num_of_chunks, chunk_size):
         """
         Check if we have all the files, combine them, and remove all the chunks
         """
-        message = {}
-        message[MESSAGE_TYPE_KEY] = QUERY_FILE_MESSAGE_TYPE
-        message[MSG_FILENAME_KEY] = filename
-        reply = self.send_message_to_tracker(message)
+        with self.part_files_lock:
+            download_part_file = self.part_files.get(filename)
+            if download_part_file is not None and download_part_file.is_complete():
+                # Every chunk is already in place, only the name has to change
+                self.part_files.pop(filename)
+                download_part_file.complete()
+                return
+        with self.download_lock:
+            if filename in self.combining_files:
+                return
+            self.combining_files.add(filename)
+        # Copying a large file takes a while, keep it off the listening thread
+        combine_thread = threading.Thread(target=self.combine_chunk_files, args=(filename, num_of_chunks, chunk_size))
+        combine_thread.daemon = True
+        combine_thread.start()
 
-        # Handle "file not found"
-        if reply[MESSAGE_TYPE_KEY] == QUERY_FILE_ERROR_MESSAGE_TYPE:
-            print(reply["error"])
-            return
+    def combine_chunk_files(self, filename, num_of_chunks, chunk_size):
+        try:
+            file_utils.combine_chunks(self.directory, filename, num_of_chunks, chunk_size,
+                                      lambda chunks_done, num_of_chunks:
+                                          self.report_combine_progress(filename, chunks_done, num_of_chunks))
+            logger.print_combine_done_message(filename)
+        finally:
+            with self.download_lock:
+                self.combining_files.discard(filename)
 
-        num_of_keys = len(reply[MSG_CHUNKS_KEY].keys())
-        file_utils.combine_chunks(self.directory, filename, num_of_keys, self.chunk_size)
+    def report_combine_progress(self, filename, chunks_done, num_of_chunks):
+        # Prints every COMBINE_PROGRESS_STEP percent
+        percent_done = chunks_done * 100 / num_of_chunks
+        if percent_done / COMBINE_PROGRESS_STEP != (chunks_done - 1) * 100 / num_of_chunks / COMBINE_PROGRESS_STEP:
+            logger.print_combine_progress_message(filename, percent_done)
 
     def hole_punching(self):
         """
@@ -404,6 +1210,11 @@ class Peer(Runner):
             logger.print_socket_error_message(msg)
             sys.exit()
         logger.print_socket_bind_message()
+        # Room for the bursts of datagrams that make up our outstanding chunks
+        self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RECEIVE_BUFFER_SIZE)
+        # Wake up periodically to retransmit chunk requests that timed out
+        self.listening_socket.settimeout(RETRANSMISSION_CHECK_INTERVAL)
+        self.upload_scheduler.start()
         self.socket_listening_thread = threading.Thread(target=self.listen_func, args=())
         self.socket_listening_thread.start()
 
@@ -422,15 +1233,37 @@ class Peer(Runner):
 
     def update_tracker_new_files(self):
         """
-        Informs the Tracker of the additional files and chunks that you are sharing
+        Informs the Tracker of the files and chunks that you started or
+        stopped sharing since the last update
         """
         self.process_dir_listing()
-        message = self.create_info_for_tracker()
-        self.send_message_to_tracker(
-            message=message,
-            success_msg=UPDATE_PEER_INFO_SUCCESS_MESSAGE,
-            failure_msg=UPDATE_PEER_INFO_FAIL_MESSAGE
-        )
+        with self.announce_lock:
+            message = self.create_delta_for_tracker()
+            if message is None:
+                print(UPDATE_PEER_INFO_SUCCESS_MESSAGE)
+                return
+            num_accepted = self.send_announcement_to_trackers(message, failure_msg=UPDATE_PEER_INFO_FAIL_MESSAGE)
+            # If some shard missed it, the next update is sent again and
+            # the shards that did accept it ask for a RESYNC
+            if num_accepted == len(self.tracker_ring.nodes):
+                self.commit_announcement(message)
+                print(UPDATE_PEER_INFO_SUCCESS_MESSAGE)
+
+    def send_heartbeat(self):
+        """
+        Tells the Tracker we are still here, it forgets peers that stay
+        silent for PEER_EXPIRY_TIMEOUT seconds
+        """
+        message = self.create_source_info()
+        message[MESSAGE_TYPE_KEY] = HEARTBEAT_MESSAGE_TYPE
+        with self.announce_lock:
+            for tracker_id in self.tracker_ring.nodes:
+                reply = self.send_message_to_tracker(message, tracker_id=tracker_id)
+                if reply is not None and reply[MESSAGE_TYPE_KEY] == RESYNC_MESSAGE_TYPE:
+                    # We were silent for too long (or the shard restarted), tell it again what
+                    # the other shards know, so that all of them stay at the same sequence number
+                    self.send_message_to_tracker(self.get_tracker_part(self.create_committed_info_for_tracker(),
+                                                                       tracker_id), tracker_id=tracker_id)
 
     def exit_network(self):
         """
@@ -443,7 +1276,8 @@ class Peer(Runner):
         else:
             message[MSG_SOURCE_PORT_KEY] = self.port
         message[MESSAGE_TYPE_KEY] = EXIT_MESSAGE_TYPE
-        self.send_message_to_tracker(message)
+        for tracker_id in self.tracker_ring.nodes:
+            self.send_message_to_tracker(message, tracker_id=tracker_id)
         logger.print_peer_exiting()
         exit()
 
@@ -475,6 +1309,8 @@ class Peer(Runner):
                     self.update_tracker_new_files()
                 elif command == 5:
                     self.exit_network()
+                elif command == 6:
+                    logger.print_stats(self.metrics.collect())
                 else:
                     logger.print_invalid_command(msg)
                     continue
@@ -490,6 +1326,8 @@ class Peer(Runner):
             self.tracker_hole_punching()
         # Start a listening socket thread
         self.listen_for_request()
+        if self.stats_server is not None:
+            self.stats_server.start()
 
         if self.hole_punch:
             self.listen_for_tracker_signal()
@@ -501,4 +1339,13 @@ class Peer(Runner):
 
     def stop(self):
         logger.print_peer_stopping_message()
+        if self.availability_refresh_thread is not None:
+            self.availability_refresh_thread.stop()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.stop()
+        self.upload_scheduler.stop()
+        if self.stats_server is not None:
+            self.stats_server.stop()
+        for tracker_connection in self.tracker_connections.values():
+            tracker_connection.close()
         self.listening_socket.close()
@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import bitfield
+from constants import *
+
+def is_valid_pex_message(message):
+    # Whether every field of a PEX message we use has the type we expect
+    file_id = message.get(MSG_FILE_DOWNLOAD_PROCESS_ID_KEY)
+    seeders = message.get(MSG_SEEDERS_KEY)
+    bitfields = message.get(MSG_BITFIELDS_KEY)
+    return (isinstance(file_id, int) and file_id >= 0
+            and isinstance(message.get(MSG_FILENAME_KEY), basestring)
+            and isinstance(seeders, list) and all(isinstance(i, basestring) for i in seeders)
+            and isinstance(bitfields, dict) and all(isinstance(i, basestring) for i in bitfields.values()))
+
+class PeerExchange(object):
+    """
+    Owners we have heard of for each file, gossiped to the peers we upload to
+
+    Owners come from Tracker replies, from PEX messages of the peers we
+    download from, and from the requesters we serve (they own a chunk once
+    we have sent it). At most PEX_MAX_OWNERS_PER_FILE are remembered per
+    file, forgetting the ones we heard of least recently.
+    """
+    def __init__(self):
+        # { filename: OrderedDict({ owner: set(chunk#, ...), or None for a seeder }) }
+        self.owners = {}
+        # { (requester, filename): time we last sent it a PEX message }
+        self.last_sent = {}
+        self.lock = threading.Lock()
+
+    def record(self, filename, owner, chunks=None):
+        # chunks=None records owner as having the whole file
+        with self.lock:
+            file_owners = self.owners.setdefault(filename, OrderedDict())
+            known_chunks = file_owners.pop(owner, set())
+            if chunks is None or known_chunks is None:
+                file_owners[owner] = None
+            else:
+                known_chunks.update(chunks)
+                file_owners[owner] = known_chunks
+            while len(file_owners) > PEX_MAX_OWNERS_PER_FILE:
+                file_owners.popitem(last=False)
+
+    def record_reply(self, reply, num_of_chunks):
+        # Remembers the owners in a QUERY_FILE_REPLY or PEX message in the bitfield format,
+        # of a file with num_of_chunks chunks
+        if MSG_SEEDERS_KEY not in reply:
+            return
+        filename = reply[MSG_FILENAME_KEY]
+        # Decoded up front, so that a bad bitfield leaves nothing half recorded
+        partial_owners = [(owner, bitfield.decode(encoded_chunks, num_of_chunks))
+                          for owner, encoded_chunks in reply[MSG_BITFIELDS_KEY].items()]
+        for owner in reply[MSG_SEEDERS_KEY]:
+            self.record(filename, owner)
+        for owner, chunks in partial_owners:
+            self.record(filename, owner, chunks)
+
+    def get_owners(self, filename):
+        with self.lock:
+            return dict(self.owners.get(filename, {}))
+
+    def create_message(self, filename, file_id, requester):
+        """
+        Returns the PEX message for requester about filename, or None if it
+        got one less than PEX_INTERVAL seconds ago or we know of no one else
+
+        The most recently heard of owners are listed first, and owners are
+        left out until the message fits in a single datagram.
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.last_sent.get((requester, filename), 0) < PEX_INTERVAL:
+                return None
+            if len(self.last_sent) > PEX_MAX_OWNERS_PER_FILE:
+                # Forget requesters that could be sent another message anyway
+                for key, sent_at in self.last_sent.items():
+                    if now - sent_at >= PEX_INTERVAL:
+                        del self.last_sent[key]
+            self.last_sent[(requester, filename)] = now
+            file_owners = [(owner, chunks) for owner, chunks in reversed(self.owners.get(filename, {}).items())
+                           if owner != requester]
+        message = {MESSAGE_TYPE_KEY: PEX_MESSAGE_TYPE, MSG_FILENAME_KEY: filename,
+                   MSG_FILE_DOWNLOAD_PROCESS_ID_KEY: file_id, MSG_SEEDERS_KEY: [], MSG_BITFIELDS_KEY: {}}
+        num_of_bytes = len(json.dumps(message))
+        for owner, chunks in file_owners[:PEX_MAX_OWNERS_PER_MESSAGE]:
+            encoded_chunks = bitfield.encode(chunks) if chunks is not None else None
+            # Rough size of the entry in the JSON message
+            entry_size = len(owner) + 6 + (len(encoded_chunks) + 4 if encoded_chunks is not None else 0)
+            if num_of_bytes + entry_size > MAX_DATAGRAM_SIZE:
+                continue
+            num_of_bytes += entry_size
+            if encoded_chunks is None:
+                message[MSG_SEEDERS_KEY].append(owner)
+            else:
+                message[MSG_BITFIELDS_KEY][owner] = encoded_chunks
+        if not message[MSG_SEEDERS_KEY] and not message[MSG_BITFIELDS_KEY]:
+            return None
+        return message
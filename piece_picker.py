@@ -0,0 +1,34 @@
+from collections import deque
+from random import random
+
+class PiecePicker(object):
+    """
+    Hands out the chunks a download still needs, rarest first
+
+    Availability is the number of owners the tracker reported for a chunk.
+    Chunks with the same availability are ordered randomly so that peers
+    downloading the same file spread their requests over different chunks.
+    """
+    def __init__(self, chunks_needed, chunks_in_flight):
+        self.queue = deque()
+        self.update(chunks_needed, chunks_in_flight)
+
+    def update(self, chunks_needed, chunks_in_flight):
+        # chunks_needed: { chunk#: [ owner, owner, ... ], ... }
+        # Chunks nobody owns right now are left out until the next update
+        pending = [chunk_number for chunk_number, owners in chunks_needed.items()
+                   if owners and chunk_number not in chunks_in_flight]
+        pending.sort(key=lambda chunk_number: (len(chunks_needed[chunk_number]), random()))
+        self.queue = deque(pending)
+
+    def next_chunk(self, chunks_needed, chunks_in_flight):
+        # Returns the rarest chunk that still needs a request, or None
+        while self.queue:
+            chunk_number = self.queue.popleft()
+            if chunk_number in chunks_needed and chunk_number not in chunks_in_flight:
+                return chunk_number
+        return None
+
+    def requeue(self, chunk_numbers):
+        # Puts chunks that could not be requested yet back at the front, in order
+        self.queue.extendleft(reversed(chunk_numbers))
@@ -18,6 +18,8 @@ class RecurringThread(object):
     def start(self):
         if not self.is_running:
             self._timer = Timer(self.interval, self._run)
+            # Do not keep the process alive just for the next run
+            self._timer.daemon = True
             self._timer.start()
             self.is_running = True
 
@@ -0,0 +1,26 @@
+class RttEstimator(object):
+    """
+    Smoothed round trip time estimator used to derive retransmission timeouts
+
+    Follows the Jacobson/Karels algorithm from RFC 6298: the timeout is the
+    smoothed RTT plus four times its mean deviation, doubled on every timeout.
+    """
+    def __init__(self, initial_rto, min_rto, max_rto):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def add_sample(self, rtt):
+        # Only feed samples known to answer the attempt they are timed from (Karn's algorithm)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.max_rto)
@@ -4,10 +4,21 @@ import sys
 import random
 import hashlib
 import logger
+import bitfield
+import framing
+import heapq
+import time
+from contextlib import contextmanager
 from threading import Thread
 from sets import Set
 from runner import Runner
 from threading import Lock
+from event_loop import EventLoopServer
+from recurring_thread import RecurringThread
+from hash_ring import HashRing
+from owner_sample import OwnerSample
+from tracker_journal import TrackerJournal
+from metrics import MetricsRegistry, StatsServer
 from constants import *
 
 class Tracker(Runner):
@@ -19,8 +30,29 @@ class Tracker(Runner):
         self.file_details = {}
         self.file_owners = {}
         self.chunk_owners = {}
+        # Sequence number of the last announce applied for each peer
+        self.peer_sequence_numbers = {}
+        # Partial owners of every chunk, kept up to date on every announce and exit
+        # { file_name: { chunk_num: OwnerSample(peer_id, ...) } }
+        self.chunk_index = {}
+        # Serialized QUERY_FILE_REPLY of each file, dropped whenever the file changes
+        # { file_name: { encoding: reply } }
+        self.file_reply_cache = {}
+        # Reverse index of what every peer owns, so a peer can be removed
+        # without looking at the files it does not have
+        # { peer_id: Set(file_name, ...) }
+        self.peer_files = {}
+        self.peer_partial_files = {}
+        # When we last heard from each peer, and a heap of (last seen, peer_id)
+        # to find the peers that went silent without scanning all of them.
+        # Entries made stale by a later heartbeat are skipped when popped.
+        self.peer_last_seen = {}
+        self.peer_expiry_heap = []
+        self.expiry_thread = None
         self.lock = Lock()
         self.port = settings[SETTINGS_PORT_KEY]
+        self.event_loop = SETTINGS_EVENT_LOOP_KEY in settings
+        self.event_loop_server = None
         self.peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.signal_port = settings[SETTINGS_SIGNAL_PORT_KEY]
         self.signal_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -33,6 +65,54 @@ class Tracker(Runner):
             sys.exit()
         logger.print_socket_bind_message()
         self.peer_socket.listen(1000)
+        # With --trackers we are one shard of a ring of Trackers, and only
+        # keep track of the files that hash to us
+        self.tracker_ring = None
+        self.tracker_id = None
+        if SETTINGS_TRACKERS_KEY in settings:
+            self.join_tracker_ring(settings)
+        # Peers restored from disk that have not checked in since we restarted
+        self.provisional_peers = Set()
+        self.journal = None
+        self.snapshot_thread = None
+        if SETTINGS_STATE_DIR_KEY in settings:
+            self.restore_state(TrackerJournal(settings[SETTINGS_STATE_DIR_KEY]))
+        self.metrics = MetricsRegistry()
+        self.create_metrics()
+        self.stats_server = None
+        if SETTINGS_STATS_PORT_KEY in settings:
+            self.stats_server = StatsServer(settings[SETTINGS_STATS_PORT_KEY], self.metrics)
+
+    def create_metrics(self):
+        self.requests_metric = self.metrics.counter(
+            "tracker_requests_total", "Requests handled, by message type", ("message_type",))
+        self.request_seconds_metric = self.metrics.histogram(
+            "tracker_request_seconds", "Time taken to handle a request, by message type", ("message_type",))
+        self.lock_wait_seconds_metric = self.metrics.histogram(
+            "tracker_lock_wait_seconds", "Time requests waited for the tracker lock")
+        self.metrics.gauge("tracker_peers", "Peers known", lambda: len(self.peer_set))
+        self.metrics.gauge("tracker_provisional_peers", "Peers restored from disk that have not checked in",
+                           lambda: len(self.provisional_peers))
+        self.metrics.gauge("tracker_files", "Files known", lambda: len(self.file_details))
+
+    def join_tracker_ring(self, settings):
+        # We are the entry of --trackers with our ports (and --tracker-address, if given)
+        trackers = settings[SETTINGS_TRACKERS_KEY]
+        own_entries = [t for t in trackers if t[1] == self.port and t[2] == self.signal_port
+                       and settings.get(SETTINGS_TRACKER_ADDRESS_KEY, t[0]) == t[0]]
+        if len(own_entries) != 1:
+            sys.exit(TRACKER_NOT_IN_RING_MESSAGE)
+        self.tracker_id = own_entries[0][0] + IP_PORT_DELIMITER + str(own_entries[0][1])
+        self.tracker_ring = HashRing([t[0] + IP_PORT_DELIMITER + str(t[1]) for t in trackers])
+
+    def get_file_tracker(self, file_name):
+        # The shard responsible for file_name, or None if we are the only Tracker
+        if self.tracker_ring is None:
+            return None
+        return self.tracker_ring.get_node(file_name)
+
+    def owns_file(self, file_name):
+        return self.tracker_ring is None or self.get_file_tracker(file_name) == self.tracker_id
 
     def create_not_yet_implemented_reply(self):
         # Format: {"message_type": "NOT_YET_IMPLEMENTED"}
@@ -40,14 +120,28 @@ class Tracker(Runner):
         msg[MESSAGE_TYPE_KEY] = NOT_YET_IMPLEMENTED_MESSAGE_TYPE
         return json.dumps(msg)
 
+    def create_query_file_error_reply(self, error):
+        # Format: {"message_type": "QUERY_FILE_ERROR", "error": "File does not exists"}
+        msg = {}
+        msg[MESSAGE_TYPE_KEY] = QUERY_FILE_ERROR_MESSAGE_TYPE
+        msg["error"] = error
+        return json.dumps(msg)
+
     def create_ack_reply(self, peer_id=None):
         # Format: {"message_type": "ACK"}
         msg = {}
         msg[MESSAGE_TYPE_KEY] = ACK_MESSAGE_TYPE
-        if peer_id == None:
+        if peer_id != None:
             msg[MSG_PEER_ID_KEY] = peer_id
         return json.dumps(msg)
 
+    def create_resync_reply(self):
+        # Format: {"message_type": "RESYNC"}
+        # Asks the peer to send its full listing in an INFORM_AND_UPDATE
+        msg = {}
+        msg[MESSAGE_TYPE_KEY] = RESYNC_MESSAGE_TYPE
+        return json.dumps(msg)
+
     def create_list_of_files_reply(self):
         # Format: {"message_type": "QUERY_LIST_OF_FILES_REPLY", "files": ["file1", "file2", ...]}
         msg = {}
@@ -63,88 +157,456 @@ class Tracker(Runner):
 
     def handle_inform_and_update_message(self, msg, addr):
         peer_id = self.get_peer_id_from_message(msg, addr)
+        self.apply_inform_and_update(peer_id, msg)
+        self.log_change(peer_id, msg)
+        return peer_id
+
+    def apply_inform_and_update(self, peer_id, msg):
+        self.validate_listing(msg[MSG_FILES_KEY], msg[MSG_CHUNKS_KEY])
         if MSG_SIGNAL_PORT_KEY in msg: # If you send a signal port, you are behind NAT
+            if peer_id not in self.public_peer_set:
+                # Every cached reply lists the peers behind NAT
+                self.file_reply_cache.clear()
             self.public_peer_set.add(peer_id)
             self.public_peer_signal[peer_id] = msg[MSG_SIGNAL_PORT_KEY]
         self.peer_set.add(peer_id)
-        for peer_files in msg[MSG_FILES_KEY]:
+        self.touch_peer(peer_id)
+        if MSG_SEQUENCE_NUMBER_KEY in msg:
+            # A full listing replaces whatever we knew about this peer, later
+            # INFORM_DELTA messages build on it
+            self.remove_peer_ownership(peer_id)
+            self.peer_sequence_numbers[peer_id] = msg[MSG_SEQUENCE_NUMBER_KEY]
+        self.add_file_owners(peer_id, msg[MSG_FILES_KEY])
+        self.add_chunk_owners(peer_id, msg[MSG_CHUNKS_KEY])
+
+    def handle_inform_delta_message(self, msg, addr):
+        # Returns the peer id, or None if the delta does not follow the last
+        # announce we have from this peer and it has to send everything again
+        peer_id = self.get_peer_id_from_message(msg, addr)
+        if not self.apply_inform_delta(peer_id, msg):
+            return None
+        self.log_change(peer_id, msg)
+        return peer_id
+
+    def apply_inform_delta(self, peer_id, msg):
+        self.validate_listing(msg[MSG_FILES_ADDED_KEY], msg[MSG_CHUNKS_ADDED_KEY] + msg[MSG_CHUNKS_REMOVED_KEY],
+                              msg[MSG_FILES_REMOVED_KEY])
+        last_sequence_number = self.peer_sequence_numbers.get(peer_id)
+        if last_sequence_number is None or msg[MSG_SEQUENCE_NUMBER_KEY] != last_sequence_number + 1:
+            return False
+        self.touch_peer(peer_id)
+        for file_name in msg[MSG_FILES_REMOVED_KEY]:
+            self.remove_file_owner(file_name, peer_id)
+        for peer_file_chunks in msg[MSG_CHUNKS_REMOVED_KEY]:
+            file_name = peer_file_chunks[MSG_FILENAME_KEY]
+            self.remove_chunk_owner(file_name, peer_id,
+                                    bitfield.get_chunk_numbers(peer_file_chunks, self.get_num_of_chunks(file_name)))
+        self.add_file_owners(peer_id, msg[MSG_FILES_ADDED_KEY])
+        self.add_chunk_owners(peer_id, msg[MSG_CHUNKS_ADDED_KEY])
+        self.peer_sequence_numbers[peer_id] = msg[MSG_SEQUENCE_NUMBER_KEY]
+        return True
+
+    def validate_listing(self, peer_files_list, peer_file_chunks_list, file_names=()):
+        """
+        Raises if any entry of an announce is malformed, before anything it
+        replaces is removed, so that a rejected announce changes nothing and
+        the state never gets ahead of the write-ahead log
+        """
+        for peer_files in peer_files_list:
+            self.validate_filename(peer_files[MSG_FILENAME_KEY])
+        for peer_file_chunks in peer_file_chunks_list:
+            self.validate_filename(peer_file_chunks[MSG_FILENAME_KEY])
+            bitfield.validate_chunk_numbers(peer_file_chunks)
+        for file_name in file_names:
+            self.validate_filename(file_name)
+
+    def validate_filename(self, file_name):
+        if not isinstance(file_name, basestring):
+            raise ValueError("Invalid filename " + repr(file_name))
+
+    def add_file_owners(self, peer_id, peer_files_list):
+        for peer_files in peer_files_list:
             file_name = peer_files[MSG_FILENAME_KEY]
+            if not self.owns_file(file_name):
+                # Announced to the wrong shard, the peer's list of Trackers differs from ours
+                continue
             # Add files into file details if this is the first time appearing
             if file_name not in self.file_details:
-                file_checksum = peer_files[MSG_CHECKSUM_KEY]
-                num_of_chunks = peer_files[MSG_NUM_OF_CHUNKS_KEY]
+                file_checksum = peer_files.get(MSG_CHECKSUM_KEY)
+                num_of_chunks = peer_files.get(MSG_NUM_OF_CHUNKS_KEY)
+                if file_checksum is None:
+                    # Only files we already know of can be listed by name alone
+                    continue
+                if not isinstance(num_of_chunks, int) or not 0 <= num_of_chunks <= MAX_CHUNKS_PER_FILE:
+                    # Every chunk of the file would be listed in replies
+                    continue
+                # The first announcer decides the chunk size everyone uses for this file
+                chunk_size = peer_files.get(MSG_CHUNK_SIZE_KEY, LEGACY_CHUNK_SIZE)
+                if not isinstance(chunk_size, int) or not (MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE
+                                                           or chunk_size == LEGACY_CHUNK_SIZE):
+                    # Downloaders allocate a chunk of this size for every chunk they get
+                    continue
+                file_size = peer_files.get(MSG_FILE_SIZE_KEY)
+                if file_size is not None and (not isinstance(file_size, int) or
+                                              not (num_of_chunks - 1) * chunk_size < file_size <= num_of_chunks * chunk_size):
+                    # Downloaders check the length of the last chunk against it
+                    continue
                 self.file_details[file_name] = {}
                 self.file_details[file_name][MSG_CHECKSUM_KEY] = file_checksum
                 self.file_details[file_name][MSG_NUM_OF_CHUNKS_KEY] = num_of_chunks
+                self.file_details[file_name][MSG_CHUNK_SIZE_KEY] = chunk_size
+                if file_size is not None:
+                    self.file_details[file_name][MSG_FILE_SIZE_KEY] = file_size
             # Add the owner to file owners
             if file_name not in self.file_owners:
                 self.file_owners[file_name] = [peer_id]
             elif peer_id not in self.file_owners[file_name]:
                 self.file_owners[file_name].append(peer_id)
+            self.peer_files.setdefault(peer_id, Set()).add(file_name)
+            self.file_reply_cache.pop(file_name, None)
+
+    def get_num_of_chunks(self, file_name):
+        # Announced chunk numbers from this on are dropped
+        if file_name in self.file_details:
+            return self.file_details[file_name][MSG_NUM_OF_CHUNKS_KEY]
+        # Chunks of a file nobody has announced in full (yet)
+        return MAX_CHUNKS_PER_FILE
 
-        for peer_file_chunks in msg[MSG_CHUNKS_KEY]:
+    def add_chunk_owners(self, peer_id, peer_file_chunks_list):
+        for peer_file_chunks in peer_file_chunks_list:
             file_name = peer_file_chunks[MSG_FILENAME_KEY]
+            if not self.owns_file(file_name):
+                continue
+            chunks = [str(i) for i in bitfield.get_chunk_numbers(peer_file_chunks, self.get_num_of_chunks(file_name))]
             if file_name not in self.chunk_owners:
-                self.chunk_owners[file_name] = {peer_id: peer_file_chunks[MSG_CHUNKS_KEY]}
+                self.chunk_owners[file_name] = {peer_id: chunks}
             elif peer_id not in self.chunk_owners[file_name]:
-                self.chunk_owners[file_name][peer_id] = peer_file_chunks[MSG_CHUNKS_KEY]
+                self.chunk_owners[file_name][peer_id] = chunks
             else:
-                updated_file_chunk_owns = list(set(self.chunk_owners[file_name][peer_id] + peer_file_chunks[MSG_CHUNKS_KEY]))
+                updated_file_chunk_owns = list(set(self.chunk_owners[file_name][peer_id] + chunks))
                 self.chunk_owners[file_name][peer_id] = updated_file_chunk_owns
-        return peer_id
+            file_chunk_index = self.chunk_index.setdefault(file_name, {})
+            for chunk_num in chunks:
+                file_chunk_index.setdefault(chunk_num, OwnerSample()).add(peer_id)
+            self.peer_partial_files.setdefault(peer_id, Set()).add(file_name)
+            self.file_reply_cache.pop(file_name, None)
+
+    def remove_file_owner(self, file_name, peer_id):
+        if file_name in self.file_owners and peer_id in self.file_owners[file_name]:
+            self.file_owners[file_name].remove(peer_id)
+            if not self.file_owners[file_name]:
+                self.file_owners.pop(file_name)
+            self.file_reply_cache.pop(file_name, None)
+        self.discard_from_peer_index(self.peer_files, peer_id, file_name)
+        self.forget_file_if_unowned(file_name)
+
+    def remove_chunk_owner(self, file_name, peer_id, chunks):
+        if file_name not in self.chunk_owners or peer_id not in self.chunk_owners[file_name]:
+            return
+        removed_chunks = set(str(i) for i in chunks)
+        remaining_chunks = [i for i in self.chunk_owners[file_name][peer_id] if i not in removed_chunks]
+        if remaining_chunks:
+            self.chunk_owners[file_name][peer_id] = remaining_chunks
+        else:
+            self.chunk_owners[file_name].pop(peer_id)
+            if not self.chunk_owners[file_name]:
+                self.chunk_owners.pop(file_name)
+            self.discard_from_peer_index(self.peer_partial_files, peer_id, file_name)
+        file_chunk_index = self.chunk_index.get(file_name, {})
+        for chunk_num in removed_chunks:
+            if chunk_num in file_chunk_index:
+                file_chunk_index[chunk_num].discard(peer_id)
+                if not file_chunk_index[chunk_num]:
+                    file_chunk_index.pop(chunk_num)
+        self.file_reply_cache.pop(file_name, None)
+        self.forget_file_if_unowned(file_name)
+
+    def forget_file_if_unowned(self, file_name):
+        # Keep the file details as long as anyone still has a part of the file
+        if file_name not in self.file_owners and file_name not in self.chunk_owners:
+            self.file_details.pop(file_name, None)
+            self.chunk_index.pop(file_name, None)
+            self.file_reply_cache.pop(file_name, None)
+
+    def discard_from_peer_index(self, peer_index, peer_id, file_name):
+        if peer_id in peer_index:
+            peer_index[peer_id].discard(file_name)
+            if not peer_index[peer_id]:
+                peer_index.pop(peer_id)
+
+    def remove_peer_ownership(self, peer_id):
+        for file_name in list(self.peer_files.get(peer_id, [])):
+            self.remove_file_owner(file_name, peer_id)
+        for file_name in list(self.peer_partial_files.get(peer_id, [])):
+            self.remove_chunk_owner(file_name, peer_id, self.chunk_owners[file_name][peer_id])
 
-    def create_file_reply(self, file_name):
+    def remove_chunk_ownership(self, file_name, peer_id):
+        if file_name in self.chunk_owners and peer_id in self.chunk_owners[file_name]:
+            self.remove_chunk_owner(file_name, peer_id, self.chunk_owners[file_name][peer_id])
+
+    def create_file_reply(self, file_name, encoding=None, max_peers=None, chunk_range=None):
+        # Replies are cached per file (and encoding) until its owners (or the
+        # peers behind NAT) change
+        if not self.owns_file(file_name):
+            return self.create_query_file_error_reply("File is tracked by " + self.get_file_tracker(file_name))
         if file_name not in self.file_details:
-            msg = {MESSAGE_TYPE_KEY: QUERY_FILE_ERROR_MESSAGE_TYPE, "error": "File does not exists"}
-            return json.dumps(msg)
-        checksum = self.file_details[file_name][MSG_CHECKSUM_KEY]
-        num_of_chunks = self.file_details[file_name][MSG_NUM_OF_CHUNKS_KEY]
-        owners = self.file_owners[file_name]
-        chunks = {}
-        if file_name in self.chunk_owners:
-            peer_id_with_chunks = self.chunk_owners[file_name]
-            for peer_id in peer_id_with_chunks.keys():
-                peer_chunks = peer_id_with_chunks[peer_id]
-                for chunk_num in peer_chunks:
-                    if str(chunk_num) in chunks:
-                        chunks[str(chunk_num)].append(peer_id)
-                    else:
-                        chunks[str(chunk_num)] = [peer_id]
-        for owner in owners:
-            for i in range(num_of_chunks):
-                if str(i) in chunks:
-                    chunks[str(i)].append(owner)
-                else:
-                    chunks[str(i)] = [owner]
+            return self.create_query_file_error_reply("File does not exists")
+        if max_peers is not None or chunk_range is not None:
+            return self.create_sampled_file_reply(file_name, encoding, max_peers, chunk_range)
+        if encoding in self.file_reply_cache.get(file_name, {}):
+            return self.file_reply_cache[file_name][encoding]
+        msg = self.create_file_reply_details(file_name)
+        msg[MSG_PEER_BEHIND_NAT_KEY] = list(self.public_peer_set)
+        if encoding == BITFIELD_ENCODING:
+            self.add_bitfield_owners(msg, file_name)
+        else:
+            self.add_chunk_list_owners(msg, file_name)
+        reply = json.dumps(msg)
+        self.file_reply_cache.setdefault(file_name, {})[encoding] = reply
+        return reply
+
+    def create_file_reply_details(self, file_name):
         msg = {MESSAGE_TYPE_KEY: QUERY_FILE_REPLY_MESSAGE_TYPE,
                MSG_FILENAME_KEY: file_name,
-               MSG_CHECKSUM_KEY: checksum,
-               MSG_CHUNKS_KEY: chunks,
-               MSG_NUM_OF_CHUNKS_KEY: num_of_chunks,
-               MSG_PEER_BEHIND_NAT_KEY: list(self.public_peer_set)
-        }
+               MSG_CHECKSUM_KEY: self.file_details[file_name][MSG_CHECKSUM_KEY],
+               MSG_NUM_OF_CHUNKS_KEY: self.file_details[file_name][MSG_NUM_OF_CHUNKS_KEY],
+               MSG_CHUNK_SIZE_KEY: self.file_details[file_name][MSG_CHUNK_SIZE_KEY]}
+        if MSG_FILE_SIZE_KEY in self.file_details[file_name]:
+            msg[MSG_FILE_SIZE_KEY] = self.file_details[file_name][MSG_FILE_SIZE_KEY]
+        return msg
+
+    def create_sampled_file_reply(self, file_name, encoding, max_peers, chunk_range):
+        """
+        Reply listing at most max_peers owners per chunk, picked at random so
+        that the load spreads over the swarm, and only for the chunks in
+        chunk_range ([first, last) chunk numbers). peer_behind_nat only lists
+        returned peers. Not cached, every query gets its own sample.
+        """
+        num_of_chunks = self.file_details[file_name][MSG_NUM_OF_CHUNKS_KEY]
+        first_chunk, last_chunk = chunk_range if chunk_range is not None else (0, num_of_chunks)
+        first_chunk = max(0, first_chunk)
+        last_chunk = min(num_of_chunks, last_chunk)
+        seeders = self.file_owners.get(file_name, [])
+        partial_owners = self.chunk_owners.get(file_name, {})
+        if max_peers is None:
+            max_peers = len(seeders) + len(partial_owners)
+        max_peers = max(1, max_peers)
+        # Partial owners get half of the places even if there are enough seeders
+        num_of_partial_owners = min(len(partial_owners), max(max_peers - len(seeders), max_peers / 2))
+        sampled_seeders = random.sample(seeders, min(len(seeders), max_peers - num_of_partial_owners))
+        msg = self.create_file_reply_details(file_name)
+        returned_peers = Set(sampled_seeders)
+        file_chunk_index = self.chunk_index.get(file_name, {})
+        is_seeder = lambda peer_id: file_name in self.peer_files.get(peer_id, ())
+        # Partial owners are sampled per chunk in both encodings, so that
+        # every chunk someone has gets owners in the reply. Owners picked
+        # for the previous chunk are reused first, which keeps the number
+        # of bitfields (and peers) in the reply small.
+        # { chunk_num: [peer_id, ...] }
+        sampled_partial_owners = {}
+        owners = []
+        for i in range(first_chunk, last_chunk):
+            chunk_owners = file_chunk_index.get(str(i))
+            if not chunk_owners:
+                owners = []
+                continue
+            owners = [o for o in owners if o in chunk_owners]
+            if len(owners) < num_of_partial_owners:
+                reused_owners = Set(owners)
+                owners += chunk_owners.sample(num_of_partial_owners - len(owners),
+                                              lambda peer_id: peer_id in reused_owners or is_seeder(peer_id))
+            if owners:
+                sampled_partial_owners[i] = owners
+        if encoding == BITFIELD_ENCODING:
+            # A bitfield per sampled owner, with the chunks it was sampled for
+            owner_chunks = {}
+            for i, owners in sampled_partial_owners.items():
+                for peer_id in owners:
+                    owner_chunks.setdefault(peer_id, []).append(i)
+            msg[MSG_SEEDERS_KEY] = sampled_seeders
+            msg[MSG_BITFIELDS_KEY] = dict((peer_id, bitfield.encode(chunks))
+                                          for peer_id, chunks in owner_chunks.items())
+            returned_peers.update(owner_chunks)
+        else:
+            chunks = {}
+            for i in range(first_chunk, last_chunk):
+                owners = sampled_partial_owners.get(i, [])
+                owners += sampled_seeders[:max_peers - len(owners)]
+                if owners:
+                    chunks[str(i)] = owners
+                    returned_peers.update(owners)
+            msg[MSG_CHUNKS_KEY] = chunks
+        msg[MSG_PEER_BEHIND_NAT_KEY] = [i for i in returned_peers if i in self.public_peer_set]
         return json.dumps(msg)
 
+    def add_chunk_list_owners(self, msg, file_name):
+        # "chunks": {"0": ["ip:port", ...], "1": [...], ...}
+        num_of_chunks = self.file_details[file_name][MSG_NUM_OF_CHUNKS_KEY]
+        owners = self.file_owners.get(file_name, [])
+        owner_set = Set(owners)
+        chunks = {}
+        for chunk_num, partial_owners in self.chunk_index.get(file_name, {}).items():
+            chunks[chunk_num] = [i for i in partial_owners if i not in owner_set]
+        if owners:
+            for i in range(num_of_chunks):
+                chunks[str(i)] = chunks.get(str(i), []) + owners
+        msg[MSG_CHUNKS_KEY] = chunks
+
+    def add_bitfield_owners(self, msg, file_name):
+        # "seeders": ["ip:port", ...] own every chunk,
+        # "bitfields": {"ip:port": "r0,12,3,4", ...} own some of them
+        owners = self.file_owners.get(file_name, [])
+        owner_set = Set(owners)
+        bitfields = {}
+        for peer_id, chunks in self.chunk_owners.get(file_name, {}).items():
+            if peer_id not in owner_set:
+                bitfields[peer_id] = bitfield.encode(chunks)
+        msg[MSG_SEEDERS_KEY] = owners
+        msg[MSG_BITFIELDS_KEY] = bitfields
+
     def handle_exit_message(self, msg, addr):
         peer_id = self.get_peer_id_from_message(msg, addr)
-        if peer_id in self.public_peer_signal:
-            self.public_peer_signal.pop(peer_id)
-        self.public_peer_set.discard(peer_id)
-        self.peer_set.discard(peer_id)
-        file_that_has_peer_as_solo_owners = []
-        file_owner_that_needs_to_be_removed = []
-        for file_name in self.file_owners:
-            if len(self.file_owners[file_name]) == 1 and self.file_owners[file_name][0] == peer_id:
-                file_that_has_peer_as_solo_owners.append(file_name)
-                file_owner_that_needs_to_be_removed.append(file_name)
-            elif peer_id in self.file_owners[file_name]:
-                file_owner_that_needs_to_be_removed.append(file_name)
-        for file_name in file_owner_that_needs_to_be_removed:
-            self.file_owners.pop(file_name)
-        for file_name in file_that_has_peer_as_solo_owners:
-            if file_name in self.file_details:
-                self.file_details.pop(file_name)
-        return
+        self.remove_peer(peer_id)
+
+    def handle_heartbeat_message(self, msg, addr):
+        # Returns False if we do not know the peer (any more) and it has to announce itself again
+        peer_id = self.get_peer_id_from_message(msg, addr)
+        if peer_id not in self.peer_set:
+            return False
+        self.touch_peer(peer_id)
+        return True
+
+    def touch_peer(self, peer_id):
+        self.provisional_peers.discard(peer_id)
+        now = time.time()
+        self.peer_last_seen[peer_id] = now
+        heapq.heappush(self.peer_expiry_heap, (now, peer_id))
+
+    def expire_peers(self):
+        """
+        Removes the peers we have not heard from for PEER_EXPIRY_TIMEOUT
+        seconds. Only looks at heap entries old enough to have expired.
+        """
+        deadline = time.time() - PEER_EXPIRY_TIMEOUT
+        expired_peers = []
+        with self.lock:
+            while self.peer_expiry_heap and self.peer_expiry_heap[0][0] < deadline:
+                last_seen, peer_id = heapq.heappop(self.peer_expiry_heap)
+                if self.peer_last_seen.get(peer_id) == last_seen:
+                    expired_peers.append((peer_id, last_seen))
+        for peer_id, last_seen in expired_peers:
+            logger.print_peer_expired_message(peer_id)
+            self.remove_peer(peer_id, last_seen)
+
+    def remove_peer(self, peer_id, last_seen=None):
+        """
+        Forgets a peer and everything it owns. Only the files in the peer's
+        reverse index are touched, a few at a time so that the lock is never
+        held for long
+
+        With last_seen, the peer is only removed if we have not heard from it since.
+        """
+        with self.lock:
+            if last_seen is not None and self.peer_last_seen.get(peer_id) != last_seen:
+                return
+            self.log_change(peer_id, {MESSAGE_TYPE_KEY: EXIT_MESSAGE_TYPE})
+            self.peer_last_seen.pop(peer_id, None)
+            self.provisional_peers.discard(peer_id)
+            if peer_id in self.public_peer_signal:
+                self.public_peer_signal.pop(peer_id)
+            if peer_id in self.public_peer_set:
+                self.file_reply_cache.clear()
+            self.public_peer_set.discard(peer_id)
+            self.peer_set.discard(peer_id)
+            self.peer_sequence_numbers.pop(peer_id, None)
+            owned_files = list(self.peer_files.pop(peer_id, []))
+            partially_owned_files = list(self.peer_partial_files.pop(peer_id, []))
+        self.remove_in_batches(owned_files, self.peer_files, peer_id, self.remove_file_owner)
+        self.remove_in_batches(partially_owned_files, self.peer_partial_files, peer_id, self.remove_chunk_ownership)
+
+    def remove_in_batches(self, file_names, peer_index, peer_id, remove_func):
+        for i in range(0, len(file_names), PEER_REMOVAL_BATCH_SIZE):
+            with self.lock:
+                # The peer may have announced again since it was removed, keep what it owns now
+                announced_again = peer_index.get(peer_id, ())
+                for file_name in file_names[i:i + PEER_REMOVAL_BATCH_SIZE]:
+                    if file_name not in announced_again:
+                        remove_func(file_name, peer_id)
+
+    def log_change(self, peer_id, msg):
+        # Appends an accepted INFORM_AND_UPDATE, INFORM_DELTA or EXIT to the
+        # write-ahead log, along with the peer it applies to
+        # Must be called with self.lock held, so the log follows the order of the changes
+        if self.journal is None:
+            return
+        entry = dict(msg)
+        entry[MSG_PEER_ID_KEY] = peer_id
+        self.journal.append(entry)
+
+    def apply_log_entry(self, entry):
+        peer_id = entry[MSG_PEER_ID_KEY]
+        if entry[MESSAGE_TYPE_KEY] == INFORM_AND_UPDATE_MESSAGE_TYPE:
+            self.apply_inform_and_update(peer_id, entry)
+        elif entry[MESSAGE_TYPE_KEY] == INFORM_DELTA_MESSAGE_TYPE:
+            self.apply_inform_delta(peer_id, entry)
+        elif entry[MESSAGE_TYPE_KEY] == EXIT_MESSAGE_TYPE:
+            self.remove_peer(peer_id)
+
+    def restore_state(self, journal):
+        """
+        Rebuilds the state from the last snapshot and the log since, before
+        we start serving
+
+        Restored peers are provisional until they heartbeat or announce, and
+        expire like any silent peer if they do not. Their sequence numbers are
+        restored too, so the peers still around carry on with heartbeats and
+        deltas instead of all sending their full listing at once.
+        """
+        snapshot, entries = journal.load()
+        if snapshot is not None:
+            self.file_details = dict((file_name, details)
+                                     for file_name, details in snapshot[SNAPSHOT_FILE_DETAILS_KEY].items()
+                                     if self.owns_file(file_name))
+            for peer_id, listing in snapshot[SNAPSHOT_PEERS_KEY].items():
+                self.apply_inform_and_update(peer_id, listing)
+        for entry in entries:
+            self.apply_log_entry(entry)
+        # A snapshot taken while a peer was being removed can hold details of files nobody owns
+        for file_name in self.file_details.keys():
+            self.forget_file_if_unowned(file_name)
+        self.provisional_peers = Set(self.peer_set)
+        self.journal = journal
+        if self.peer_set:
+            logger.print_tracker_state_restored_message(len(self.peer_set), len(self.file_details))
+
+    def create_snapshot(self, generation):
+        # Every peer's listing in the INFORM_AND_UPDATE format, plus the file details
+        # Must be called with self.lock held
+        peers = {}
+        for peer_id in self.peer_set:
+            listing = {}
+            listing[MSG_FILES_KEY] = [{MSG_FILENAME_KEY: file_name} for file_name in self.peer_files.get(peer_id, ())]
+            listing[MSG_CHUNKS_KEY] = [{MSG_FILENAME_KEY: file_name,
+                                        MSG_BITFIELD_KEY: bitfield.encode(self.chunk_owners[file_name][peer_id])}
+                                       for file_name in self.peer_partial_files.get(peer_id, ())]
+            if peer_id in self.peer_sequence_numbers:
+                listing[MSG_SEQUENCE_NUMBER_KEY] = self.peer_sequence_numbers[peer_id]
+            if peer_id in self.public_peer_signal:
+                listing[MSG_SIGNAL_PORT_KEY] = self.public_peer_signal[peer_id]
+            peers[peer_id] = listing
+        return {SNAPSHOT_GENERATION_KEY: generation,
+                SNAPSHOT_FILE_DETAILS_KEY: dict(self.file_details),
+                SNAPSHOT_PEERS_KEY: peers}
+
+    def snapshot_state(self):
+        # Writes a snapshot if anything changed since the last one, the log
+        # entries it covers are then deleted
+        with self.lock:
+            if self.journal.num_of_entries == 0:
+                return
+            generation = self.journal.rotate()
+            snapshot = self.create_snapshot(generation)
+        self.journal.write_snapshot(snapshot)
 
     def send_signal(self, msg, addr):
         signal_msg = {}
@@ -157,49 +619,171 @@ class Tracker(Runner):
         signal_msg[MSG_FILENAME_KEY] = msg[MSG_FILENAME_KEY]
         signal_msg[MSG_FILE_DOWNLOAD_PROCESS_ID_KEY] = msg[MSG_FILE_DOWNLOAD_PROCESS_ID_KEY]
         signal_msg[MSG_CHUNK_NUMBER_KEY] = msg[MSG_CHUNK_NUMBER_KEY]
+        signal_msg[MSG_CHUNK_SIZE_KEY] = msg.get(MSG_CHUNK_SIZE_KEY, LEGACY_CHUNK_SIZE)
+        if MSG_MISSING_DATAGRAMS_KEY in msg:
+            signal_msg[MSG_MISSING_DATAGRAMS_KEY] = msg[MSG_MISSING_DATAGRAMS_KEY]
+        if MSG_ATTEMPT_KEY in msg:
+            signal_msg[MSG_ATTEMPT_KEY] = msg[MSG_ATTEMPT_KEY]
         logger.print_returning_data(signal_msg)
         self.signal_socket.sendto(json.dumps(signal_msg), (dst_addr[0], int(self.public_peer_signal[msg[MSG_OWNER_ADDRESS_KEY]])))
 
     def parse_msg(self, data, addr):
-        msg = json.loads(data)
-        if MESSAGE_TYPE_KEY not in msg:
+        start_time = time.time()
+        try:
+            msg = json.loads(data)
+        except ValueError:
+            msg = None
+        if not isinstance(msg, dict) or MESSAGE_TYPE_KEY not in msg:
             logger.print_not_yet_implemented_message()
             return self.create_not_yet_implemented_reply()
+        try:
+            reply = self.dispatch_msg(msg, addr)
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+            # A field is missing or has the wrong type, the request is rejected
+            # rather than taking the connection (or the event loop) down
+            logger.print_malformed_message(e)
+            if msg[MESSAGE_TYPE_KEY] == QUERY_FILE_MESSAGE_TYPE:
+                reply = self.create_query_file_error_reply(MALFORMED_REQUEST_ERROR)
+            else:
+                reply = self.create_not_yet_implemented_reply()
+        # Message types we do not know are counted together, whatever peers make up
+        if reply is None:
+            logger.print_not_yet_implemented_message()
+            reply = self.create_not_yet_implemented_reply()
+            message_type = UNKNOWN_MESSAGE_TYPE
+        else:
+            message_type = msg[MESSAGE_TYPE_KEY]
+        self.requests_metric.labels(message_type).inc()
+        self.request_seconds_metric.labels(message_type).observe(time.time() - start_time)
+        return reply
+
+    @contextmanager
+    def timed_lock(self):
+        # with self.lock, recording how long we waited for it
+        start_time = time.time()
+        with self.lock:
+            self.lock_wait_seconds_metric.observe(time.time() - start_time)
+            yield
+
+    def dispatch_msg(self, msg, addr):
         if msg[MESSAGE_TYPE_KEY] == INFORM_AND_UPDATE_MESSAGE_TYPE:
-            self.lock.acquire()
-            peer_id = self.handle_inform_and_update_message(msg, addr)
-            self.lock.release()
+            with self.timed_lock():
+                peer_id = self.handle_inform_and_update_message(msg, addr)
+            return self.create_ack_reply(peer_id=peer_id)
+        elif msg[MESSAGE_TYPE_KEY] == INFORM_DELTA_MESSAGE_TYPE:
+            with self.timed_lock():
+                peer_id = self.handle_inform_delta_message(msg, addr)
+            if peer_id is None:
+                return self.create_resync_reply()
             return self.create_ack_reply(peer_id=peer_id)
         elif msg[MESSAGE_TYPE_KEY] == QUERY_LIST_OF_FILES_MESSAGE_TYPE:
             return self.create_list_of_files_reply()
         elif msg[MESSAGE_TYPE_KEY] == QUERY_FILE_MESSAGE_TYPE:
-            return self.create_file_reply(msg[MSG_FILENAME_KEY])
+            file_name = msg[MSG_FILENAME_KEY]
+            chunk_range = None
+            if MSG_FIRST_CHUNK_KEY in msg or MSG_LAST_CHUNK_KEY in msg:
+                chunk_range = (int(msg.get(MSG_FIRST_CHUNK_KEY, 0)), int(msg.get(MSG_LAST_CHUNK_KEY, sys.maxint)))
+            max_peers = msg.get(MSG_MAX_PEERS_KEY)
+            if max_peers is not None:
+                max_peers = int(max_peers)
+            with self.timed_lock():
+                return self.create_file_reply(file_name, msg.get(MSG_ENCODING_KEY), max_peers, chunk_range)
         elif msg[MESSAGE_TYPE_KEY] == REQUEST_FILE_CHUNK_NAT_MESSAGE_TYPE:
             self.send_signal(msg, addr)
             return self.create_ack_reply()
         elif msg[MESSAGE_TYPE_KEY] == EXIT_MESSAGE_TYPE:
-            self.lock.acquire()
-            self.handle_exit_message(msg)
-            self.lock.release()
+            self.handle_exit_message(msg, addr)
+            return self.create_ack_reply()
+        elif msg[MESSAGE_TYPE_KEY] == HEARTBEAT_MESSAGE_TYPE:
+            with self.timed_lock():
+                is_known_peer = self.handle_heartbeat_message(msg, addr)
+            if not is_known_peer:
+                return self.create_resync_reply()
             return self.create_ack_reply()
 
     def handle_connection(self, conn, addr):
-        data = conn.recv(1024)
-        logger.print_received_data(data)
+        try:
+            first_byte = conn.recv(1, socket.MSG_PEEK)
+            if first_byte == "{":
+                self.handle_legacy_connection(conn, addr)
+                return
+            # Framed connection, serve requests until the peer hangs up
+            while True:
+                frame = framing.recv_frame(conn)
+                if frame is None:
+                    break
+                request_id, data = frame
+                framing.send_frame(conn, request_id, self.handle_message(data, addr))
+        except Exception as msg:
+            logger.print_connection_error_message(addr, msg)
+        finally:
+            conn.close()
+
+    def handle_legacy_connection(self, conn, addr):
+        # Unframed peers send a single JSON message and wait for us to close
+        # the connection after the reply
+        data = ""
+        while True:
+            new_bytes = conn.recv(4096)
+            if not new_bytes:
+                break
+            data += new_bytes
+            try:
+                json.loads(data)
+                break
+            except ValueError:
+                continue
         if data:
-            return_data = self.parse_msg(data, addr)
-            logger.print_returning_data(return_data)
-            conn.sendall(return_data)
-        conn.close()
+            conn.sendall(self.handle_message(data, addr))
+
+    def handle_message(self, data, addr):
+        logger.print_received_data(data)
+        return_data = self.parse_msg(data, addr)
+        logger.print_returning_data(return_data)
+        return return_data
+
+    def handle_signal_datagram(self, data, addr):
+        # Peers only send to the signal socket to punch a hole in their NAT,
+        # there is nothing to reply
+        return
 
     def start_tracker(self):
+        self.expiry_thread = RecurringThread(PEER_EXPIRY_CHECK_INTERVAL, self.expire_peers)
+        if self.stats_server is not None:
+            self.stats_server.start()
+        if self.journal is not None:
+            self.snapshot_thread = RecurringThread(TRACKER_SNAPSHOT_INTERVAL, self.snapshot_state)
+        if self.event_loop:
+            self.start_event_loop_tracker()
+            return
         while 1:
             conn, addr = self.peer_socket.accept()
             t = Thread(target=self.handle_connection, args=(conn, addr))
             t.start()
         self.peer_socket.close()
 
+    def start_event_loop_tracker(self):
+        """
+        Serves every peer connection and the signal socket from this thread
+        instead of starting a thread per connection
+        """
+        self.event_loop_server = EventLoopServer(self.peer_socket, self.signal_socket,
+                                                 self.handle_message, self.handle_signal_datagram)
+        self.event_loop_server.serve_forever()
+
     def stop(self):
         logger.print_tracker_stopping_message()
+        if self.expiry_thread is not None:
+            self.expiry_thread.stop()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.stop()
+        if self.stats_server is not None:
+            self.stats_server.stop()
+        if self.journal is not None:
+            # Restart from a snapshot rather than a long log
+            self.snapshot_state()
+            self.journal.close()
+        if self.event_loop_server is not None:
+            self.event_loop_server.stop()
         self.peer_socket.close()
         self.signal_socket.close()
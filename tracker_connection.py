@@ -0,0 +1,53 @@
+import socket
+import json
+import framing
+
+from threading import Lock
+from constants import *
+
+class TrackerConnection(object):
+    """
+    Long-lived connection to a Tracker, shared by all the Peer's threads
+
+    Messages are framed (see framing.py) so any number of requests can be
+    sent over the same connection, one at a time. A broken connection is
+    re-established once per request before giving up.
+    """
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+        self.sock = None
+        self.next_request_id = 1
+        self.lock = Lock()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), TRACKER_CONNECTION_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, message):
+        # Sends message and returns the Tracker's (decoded) reply
+        with self.lock:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            payload = json.dumps(message)
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    framing.send_frame(self.sock, request_id, payload)
+                    frame = framing.recv_frame(self.sock)
+                    if frame is None:
+                        raise socket.error("Tracker closed the connection")
+                    reply_id, data = frame
+                    if reply_id != request_id:
+                        raise socket.error("Reply " + str(reply_id) + " does not match request " + str(request_id))
+                    return json.loads(data)
+                except socket.error:
+                    self.close()
+                    if attempt == 1:
+                        raise
@@ -0,0 +1,110 @@
+import os
+import glob
+import json
+
+from constants import *
+
+class TrackerJournal(object):
+    """
+    Write-ahead log and snapshots of the Tracker's state, kept in a directory
+
+    Every accepted change is appended to the log of the current generation
+    (tracker.<generation>.log) as one JSON line before the Tracker replies.
+    A snapshot moves appends on to the next generation's log, and once the
+    state as of that moment is written out, the logs it covers are deleted.
+    Loading reads the snapshot and the logs of its generation and later ones.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.generation = 0
+        self.log_file = None
+        # Entries appended since the last snapshot
+        self.num_of_entries = 0
+
+    def get_log_path(self, generation):
+        return os.path.join(self.directory, TRACKER_LOG_PREFIX + str(generation) + TRACKER_LOG_EXTENSION)
+
+    def get_snapshot_path(self):
+        return os.path.join(self.directory, TRACKER_SNAPSHOT_FILENAME)
+
+    def get_log_generations(self):
+        generations = []
+        for log_path in glob.glob(os.path.join(self.directory, TRACKER_LOG_PREFIX + "*" + TRACKER_LOG_EXTENSION)):
+            generation = os.path.basename(log_path)[len(TRACKER_LOG_PREFIX):-len(TRACKER_LOG_EXTENSION)]
+            if generation.isdigit():
+                generations.append(int(generation))
+        return sorted(generations)
+
+    def load(self):
+        """
+        Returns (snapshot, entries): the last snapshot (None if there is
+        none) and the log entries made after it, oldest first
+
+        Appends then go to a new log, so that nothing is ever written after
+        a line torn by a crash.
+        """
+        snapshot = None
+        try:
+            with open(self.get_snapshot_path(), 'r') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (IOError, ValueError):
+            # No snapshot yet (or a corrupt one), the logs hold everything
+            snapshot = None
+        first_generation = snapshot[SNAPSHOT_GENERATION_KEY] if snapshot is not None else 0
+        generations = self.get_log_generations()
+        entries = []
+        for generation in generations:
+            if generation < first_generation:
+                continue
+            with open(self.get_log_path(generation), 'r') as log_file:
+                for line in log_file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Torn write at the end of the log
+                        break
+        self.generation = max(generations + [first_generation]) + 1
+        self.num_of_entries = len(entries)
+        self.open_log()
+        return snapshot, entries
+
+    def open_log(self):
+        self.log_file = open(self.get_log_path(self.generation), 'a')
+
+    def append(self, entry):
+        # The entry reaches the OS before the Tracker replies, so it survives
+        # the Tracker crashing (though not the machine)
+        self.log_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.log_file.flush()
+        self.num_of_entries += 1
+
+    def rotate(self):
+        """
+        Starts the log of the next generation and returns that generation
+
+        Must be called together with capturing the state for the snapshot of
+        that generation, without changes to the state in between.
+        """
+        self.log_file.close()
+        self.generation += 1
+        self.num_of_entries = 0
+        self.open_log()
+        return self.generation
+
+    def write_snapshot(self, snapshot):
+        # Write to a temporary file first so a crash never leaves half a snapshot behind
+        snapshot_path = self.get_snapshot_path()
+        temp_path = snapshot_path + ".tmp"
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file, separators=(",", ":"))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.rename(temp_path, snapshot_path)
+        for generation in self.get_log_generations():
+            if generation < snapshot[SNAPSHOT_GENERATION_KEY]:
+                os.remove(self.get_log_path(generation))
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
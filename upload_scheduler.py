@@ -0,0 +1,110 @@
+import threading
+import time
+import logger
+from collections import deque
+
+from constants import *
+
+class TokenBucket(object):
+    """
+    Caps a byte rate: consume blocks until enough tokens have accumulated
+
+    Tokens accrue at rate per second up to burst, so short bursts go out at
+    full speed while the long run average stays at rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, MAX_DATAGRAM_SIZE))
+        self.tokens = self.burst
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+class UploadScheduler(object):
+    """
+    Serves chunk requests on a fixed pool of worker threads
+
+    Every requester has its own queue and the workers take one request from
+    each requester in turn, so a peer asking for many chunks at once cannot
+    push everyone else's requests back. A request for a chunk that is already
+    queued for the same requester replaces the queued one.
+    """
+    def __init__(self, num_of_workers, serve_func):
+        self.num_of_workers = num_of_workers
+        self.serve_func = serve_func
+        # { requester: deque([(key, args), ...]) }
+        self.queues = {}
+        # Requesters with queued requests, in the order they are served
+        self.ready_requesters = deque()
+        self.condition = threading.Condition()
+        self.is_running = False
+        self.workers = []
+
+    def start(self):
+        self.is_running = True
+        for i in range(self.num_of_workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+
+    def submit(self, requester, key, args):
+        # Returns False if the requester already has too many requests queued
+        with self.condition:
+            queue = self.queues.get(requester)
+            if queue is None:
+                queue = deque()
+                self.queues[requester] = queue
+                self.ready_requesters.append(requester)
+            for i, (queued_key, queued_args) in enumerate(queue):
+                if queued_key == key:
+                    queue[i] = (key, args)
+                    return True
+            if len(queue) >= MAX_QUEUED_UPLOADS_PER_REQUESTER:
+                return False
+            queue.append((key, args))
+            self.condition.notify()
+            return True
+
+    def next_request(self):
+        # Blocks until there is a request to serve, None once stopped
+        with self.condition:
+            while self.is_running and not self.ready_requesters:
+                self.condition.wait()
+            if not self.is_running:
+                return None
+            requester = self.ready_requesters.popleft()
+            queue = self.queues[requester]
+            key, args = queue.popleft()
+            if queue:
+                self.ready_requesters.append(requester)
+            else:
+                self.queues.pop(requester)
+            return args
+
+    def work(self):
+        while True:
+            args = self.next_request()
+            if args is None:
+                return
+            try:
+                self.serve_func(*args)
+            except Exception as e:
+                # Keep the worker alive for the other requests
+                logger.print_upload_error_message(e)